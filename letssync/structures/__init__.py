@@ -1,6 +1,29 @@
 from letssync.structures import base
+from letssync.structures import fsio
 from letssync.structures import account
 from letssync.structures import renewal
+from letssync.structures import snapshot as _snapshot
 
-def build_tree(root_path):
-    return base.Directory(path=root_path)
+def build_tree(root_path, lazy=False, snapshot=None, workers=None):
+    """Builds a tree from the filesystem starting at the given path
+
+    Arguments:
+        root_path (str): The root directory (typically "/etc/letsencrypt")
+        lazy (bool): If :const:`True`, file contents and parsed data are
+            loaded on first access. default is :const:`False`
+        snapshot: A previously built tree, its JSON string or a snapshot
+            file (see :class:`~letssync.structures.snapshot.Snapshot`).
+            If given, only files that have changed since will be read
+        workers (int): If given, the directories are scanned and files read
+            by a pool of this many threads
+            (see :class:`~letssync.structures.fsio.ParallelScanner`) before
+            the tree is assembled
+    """
+    if snapshot is not None:
+        snapshot = _snapshot.Snapshot.load(snapshot)
+    fs = None
+    if workers:
+        fs = fsio.ParallelScanner(
+            root_path, workers, read_files=not lazy, snapshot=snapshot,
+        ).run()
+    return base.Directory(path=root_path, lazy=lazy, snapshot=snapshot, fs=fs)
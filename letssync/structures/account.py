@@ -1,4 +1,4 @@
-import os
+import copy
 import json
 
 from letssync.structures.base import Directory, FileObjBase
@@ -12,6 +12,7 @@ class Accounts(Directory):
             Only one instance of :class:`Accounts` will hold the :class:`dict`
             object, all others will reference it indirectly.
     """
+    __slots__ = ('_accounts',)
     @property
     def accounts(self):
         a = getattr(self, '_accounts', None)
@@ -34,9 +35,38 @@ class Accounts(Directory):
         if isinstance(child, Account):
             self.add_account(child)
         return child
+    def _clone_attrs(self, source):
+        super(Accounts, self)._clone_attrs(source)
+        self._accounts = None
+    def _post_clone(self):
+        super(Accounts, self)._post_clone()
+        for child in self.children.values():
+            if isinstance(child, Account):
+                self.add_account(child)
+    @property
+    def accounts_owner(self):
+        """The outermost :class:`Accounts` node, which holds :attr:`accounts`
+        """
+        obj = self
+        while isinstance(obj.parent, Accounts):
+            obj = obj.parent
+        return obj
+    def remove_child(self, key):
+        child = super(Accounts, self).remove_child(key)
+        if self.accounts.get(child.id) is child:
+            del self.accounts[child.id]
+            self.accounts_owner.invalidate_hash()
+        return child
     def add_account(self, obj):
         if obj.id not in self.accounts:
             self.accounts[obj.id] = obj
+            self.accounts_owner.invalidate_hash()
+    def get_hash_data(self):
+        data = super(Accounts, self).get_hash_data()
+        # Only hashed once, by the node holding the shared dict
+        if not isinstance(self.parent, Accounts):
+            data.extend(sorted(self.accounts.keys()))
+        return data
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
@@ -49,8 +79,15 @@ class Account(Directory):
     :attr:`~letssync.structures.base.Path.id`
     Data is read from the files within the account directory:
     'meta.json', 'private_key.json' and 'regr.json'
+
+    Attributes:
+        domains (list): The domain names associated with the account.
+            These are gathered from the renewal configuration once the tree
+            is built (on first access for :attr:`~letssync.structures.base.Path.lazy`
+            trees)
     """
     serialize_attrs = ['meta', 'private_key', 'regr', 'domains']
+    __slots__ = ('_domains', '_domains_pending')
     @classmethod
     def _child_class_override(cls, child_class, **kwargs):
         parent = kwargs.get('parent')
@@ -58,19 +95,65 @@ class Account(Directory):
             return Account
     def read(self, **kwargs):
         super(Account, self).read(**kwargs)
-        self.domains = kwargs.get('domains', [])
+        self._domains = kwargs.get('domains', [])
+        self._domains_pending = False
     def add_child(self, cls, **kwargs):
         cls = AccountFile
-        obj = super(Account, self).add_child(cls, **kwargs)
-        attr = os.path.splitext(obj.id)[0]
-        setattr(self, attr, obj.data)
-        return obj
-    def on_tree_built(self):
+        return super(Account, self).add_child(cls, **kwargs)
+    def _clone_attrs(self, source):
+        super(Account, self)._clone_attrs(source)
+        self._domains = list(source._domains)
+    def update_attrs(self, **kwargs):
+        for key in ['meta', 'private_key', 'regr']:
+            kwargs.pop(key, None)
+        domains = kwargs.pop('domains', None)
+        if domains is not None:
+            self._domains = list(domains)
+            self.invalidate_hash()
+        super(Account, self).update_attrs(**kwargs)
+    def get_file_data(self, fn):
+        obj = self.children.get(fn)
+        if obj is None:
+            return None
+        return obj.data
+    @property
+    def meta(self):
+        return self.get_file_data('meta.json')
+    @property
+    def private_key(self):
+        return self.get_file_data('private_key.json')
+    @property
+    def regr(self):
+        return self.get_file_data('regr.json')
+    @property
+    def domains(self):
+        if self._domains_pending:
+            self._domains_pending = False
+            self.update_domains()
+        return self._domains
+    def update_domains(self):
+        """Adds any domains found in the renewal configuration to :attr:`domains`
+        """
         renewal = self.root.children['renewal']
-        for key in renewal.accounts[self.id].keys():
-            if key in self.domains:
+        for key in renewal.accounts.get(self.id, {}).keys():
+            if key in self._domains:
                 continue
-            self.domains.append(key)
+            self._domains.append(key)
+            self.invalidate_hash()
+    def get_hash_data(self):
+        data = super(Account, self).get_hash_data()
+        data.extend(sorted(self.domains))
+        return data
+    def _on_tree_built(self):
+        # Copies of lazy trees also wait until the domains are needed
+        if self.lazy or self._domains_pending:
+            self._domains_pending = True
+        else:
+            self.update_domains()
+    def quick_equal(self, other, attrs=None):
+        # The domains are read from the renewal configuration, which is
+        # checked on its own, so only the directory itself is compared
+        return super(Account, self).__eq__(other)
     def __eq__(self, other):
         r = super(Account, self).__eq__(other)
         if not r:
@@ -79,23 +162,101 @@ class Account(Directory):
 
 class AccountFile(FileObjBase):
     """A file used to read and store data used in :class:`Account`
+
+    Attributes:
+        data (dict): The parsed JSON content
     """
     serialize_attrs = ['data']
+    __slots__ = ('_data', '_shared_data')
     def read(self, **kwargs):
-        self.data = kwargs.get('data')
-        if self.data is not None:
-            kwargs.setdefault('content', json.dumps(self.data))
+        data = self.data = kwargs.get('data')
+        if data is not None:
+            kwargs.setdefault('content', json.dumps(data))
+        # Data parsed by an earlier build is only copied if accessed
+        self._shared_data = kwargs.get('shared_data')
         super(AccountFile, self).read(**kwargs)
-        if self.data is None:
-            self.data = json.loads(self.content)
+        if not self.lazy:
+            self._get_data()
+    def get_snapshot_kwargs(self):
+        kwargs = super(AccountFile, self).get_snapshot_kwargs()
+        d = getattr(self, '_data', None)
+        if d is None:
+            d = getattr(self, '_shared_data', None)
+        if d is not None:
+            kwargs['shared_data'] = d
+        return kwargs
+    def _clone_attrs(self, source):
+        super(AccountFile, self)._clone_attrs(source)
+        self._data = None
+        # Data not parsed yet is parsed from the copied content when needed
+        self._shared_data = getattr(source, '_data', None)
+        if self._shared_data is None:
+            self._shared_data = getattr(source, '_shared_data', None)
+    @property
+    def data(self):
+        d = getattr(self, '_data', None)
+        if d is not None:
+            return d
+        shared = getattr(self, '_shared_data', None)
+        if shared is not None:
+            d = copy.deepcopy(shared)
+        else:
+            d = json.loads(self.content)
+        # Kept on the instance once handed out so changes made to it in
+        # place are never dropped (only the raw content is cached) and
+        # are included in the hashes
+        self._data = d
+        self._shared_data = None
+        self.mark_mutable()
+        return d
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._shared_data = None
+        self.invalidate_hash()
+        self.mark_dirty()
+        if value is not None:
+            self.mark_mutable()
+    def _get_data(self):
+        # Read-only access which does not copy shared data (or keep data
+        # parsed from the content of lazy trees)
+        d = getattr(self, '_data', None)
+        if d is not None:
+            return d
+        shared = getattr(self, '_shared_data', None)
+        if shared is not None:
+            return shared
+        if self.lazy:
+            return json.loads(self.content)
+        return self.data
+    def get_file_content(self):
+        """Retrieves the content to be written, serializing :attr:`data`
+        if it no longer matches the content read
+        """
+        c = self.content
+        d = getattr(self, '_data', None)
+        if d is None or json.loads(c) == d:
+            return c
+        return json.dumps(d)
+    def get_hash_data(self):
+        data = super(AccountFile, self).get_hash_data()
+        data.append(json.dumps(self._get_data(), sort_keys=True))
+        return data
+    def _diff_attrs(self, other):
+        attrs = super(AccountFile, self)._diff_attrs(other)
+        if self._get_data() != other._get_data():
+            attrs.append('data')
+        return attrs
     def _get_diff(self, other, other_name):
         d = super(AccountFile, self)._get_diff(other, other_name)
         if other is None:
             return d
-        if self.data != other.data:
-            d['data'] = {self.name:self.data, other_name:other.data}
+        self_data = self._get_data()
+        other_data = other._get_data()
+        if self_data != other_data:
+            d['data'] = {self.name:self_data, other_name:other_data}
         return d
     def __eq__(self, other):
         if not isinstance(other, AccountFile):
             return False
-        return other.data == self.data
+        return other._get_data() == self._get_data()
@@ -1,86 +1,540 @@
 import os
+import sys
+import stat
 import json
-import difflib
+import operator
+import hashlib
 
-class Path(object):
+from letssync.structures import fsio
+from letssync.structures.fsio import to_bytes
+
+
+try:
+    _intern = sys.intern
+except AttributeError: # pragma: no cover
+    _intern = intern
+
+def intern_str(s):
+    """Interns a path component so that equal names share one object
+    """
+    if isinstance(s, str):
+        return _intern(s)
+    return s
+
+WALK_SKIP = 'skip'
+WALK_STOP = 'stop'
+
+DIRTY_NODE = 1
+"""Flag set on a node that has changed since it was built or written"""
+DIRTY_CHILDREN = 2
+"""Flag set on a node with changed descendants"""
+
+MUTABLE_NODE = 1
+"""Flag set on a node holding data that may be changed in place
+(see :meth:`Path.mark_mutable`)"""
+MUTABLE_CHILDREN = 2
+"""Flag set on a node with descendants holding mutable data"""
+
+def _iter_children(node):
+    return node.children.values()
+
+def walk_tree(start, pre=None, post=None, get_children=None):
+    """Visits the items of a tree without recursion
+
+    Items are visited depth first with children in the order given by
+    ``get_children``.
+
+    Arguments:
+        start: The first item (normally a :class:`Path`)
+        pre: If given, called with each item before its children. It may
+            return :data:`WALK_SKIP` to skip the item's children (and
+            ``post`` for the item) or :data:`WALK_STOP` to end the walk
+        post: If given, called with each item after all of its children
+        get_children: A callable returning the children of an item
+            (as a sized iterable such as a :class:`list`).
+            Defaults to the values of :attr:`Path.children`. Custom items
+            (such as pairs of nodes from two trees) can be walked with this
+
+    Returns:
+        bool: :const:`False` if the walk was stopped by ``pre``,
+        otherwise :const:`True`
+    """
+    if post is None:
+        # Only pre-order visits are needed, so the stack can hold the items
+        stack = [start]
+        while stack:
+            item = stack.pop()
+            if pre is not None:
+                r = pre(item)
+                if r is WALK_SKIP:
+                    continue
+                if r is WALK_STOP:
+                    return False
+            if get_children is None:
+                children = item.children
+                if children:
+                    stack.extend(reversed(list(children.values())))
+                continue
+            children = get_children(item)
+            if len(children):
+                stack.extend(reversed(list(children)))
+        return True
+    if get_children is None:
+        get_children = _iter_children
+    stack = [(start, False)]
+    while stack:
+        item, visited = stack.pop()
+        if visited:
+            post(item)
+            continue
+        if pre is not None:
+            r = pre(item)
+            if r is WALK_SKIP:
+                continue
+            if r is WALK_STOP:
+                return False
+        stack.append((item, True))
+        children = get_children(item)
+        if len(children):
+            stack.extend([(child, False) for child in reversed(list(children))])
+    return True
+
+def zip_children(nodes):
+    """Matches up the children of several nodes by their keys
+
+    Arguments:
+        nodes: A sequence of nodes (items may be :const:`None`)
+
+    Returns:
+        list: A :class:`tuple` for each key found in any of the nodes
+        (in order of first appearance) holding the child from each node,
+        or :const:`None` where a node has no such child
+    """
+    keys = []
+    seen = set()
+    for node in nodes:
+        if node is None:
+            continue
+        for key in node.children:
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+    children = []
+    for key in keys:
+        children.append(tuple(
+            None if node is None else node.children.get(key) for node in nodes
+        ))
+    return children
+
+def with_metaclass(meta, *bases):
+    # Python 2 and 3 compatible metaclass declaration (as used by "six")
+    class metaclass(type):
+        def __new__(cls, name, this_bases, d):
+            return meta(name, bases, d)
+    return type.__new__(metaclass, 'temporary_class', (), {})
+
+
+class PathMeta(type):
+    """Metaclass for :class:`Path` which keeps track of all subclasses
+
+    Attributes:
+        registry (dict): All classes using this metaclass with their
+            names as keys (the first class defined with a name is used)
+        override_chains (dict): Cached results of
+            :meth:`Path.get_override_chain`. This is cleared whenever
+            a new class is defined
+
+    The serialized attributes of each class (see
+    :meth:`Path.get_serialize_attrs`) and the names of all of its
+    :attr:`~object.__slots__` are gathered once when it is defined.
+    """
+    registry = {}
+    override_chains = {}
+    def __init__(cls, name, bases, attrs):
+        super(PathMeta, cls).__init__(name, bases, attrs)
+        PathMeta.registry.setdefault(name, cls)
+        PathMeta.override_chains.clear()
+        cls._build_serialize_attrs()
+        slot_attrs = []
+        for _cls in reversed(cls.__mro__):
+            for attr in _cls.__dict__.get('__slots__', ()):
+                if attr not in ('__dict__', '__weakref__'):
+                    slot_attrs.append(attr)
+        cls._slot_attrs = tuple(slot_attrs)
+    def _build_serialize_attrs(cls):
+        attrs = []
+        fields = {}
+        # Base classes first so the order is stable between runs
+        for _cls in reversed(cls.__mro__):
+            for attr in _cls.__dict__.get('serialize_attrs', []):
+                if attr not in attrs:
+                    attrs.append(attr)
+            fields.update(_cls.__dict__.get('serialize_fields', {}))
+        cls._serialize_attrs = tuple(attrs)
+        if len(attrs):
+            getter = operator.attrgetter(*[fields.get(attr, attr) for attr in attrs])
+            if len(attrs) == 1:
+                _getter = getter
+                getter = lambda obj: (_getter(obj),)
+            cls._serialize_getter = staticmethod(getter)
+        else:
+            cls._serialize_getter = staticmethod(lambda obj: ())
+
+
+class Path(with_metaclass(PathMeta, object)):
     """Base class for all file/directory structures
     All instances of :class:`Path` serve as nodes of a tree through their
     :attr:`parent` and :attr:`children` attributes.
 
+    Nodes use :attr:`~object.__slots__` to keep large trees compact, so
+    subclasses should define :attr:`~object.__slots__` for any attributes
+    they add.
+
     Attributes:
         name (str): Name of the tree. (Only stored on the root)
-        path (str): The full filesystem path of the instance,
-            this is automatically set when child nodes are built.
-            If set after initialization, all child nodes will adjust their
-            paths relative to this. (This should only be performed on
-            'root' nodes)
-        id (str): The directory name or filename (relative to the parent)
+        path (str): The full filesystem path of the instance.
+            This is only stored on the root. For all other nodes it is
+            derived from the root's path and :attr:`relative_path`, so
+            setting it on the root moves the entire tree.
+        id (str): The directory name or filename (relative to the parent).
+            This is interned since the same names appear throughout a tree
         parent: Reference to the parent instance.  If :const:`None`,
             this will act as the 'root' of the tree structure.
         is_serialized (bool): Is set to :const:`True` when an instance is either
             copied or deserialized. Used internally to control how child objects
             are built.
+        is_dirty (bool): :const:`True` if this node or any of its descendants
+            need to be written (see :meth:`mark_dirty`)
+        lazy (bool): If :const:`True`, file contents and parsed data are not
+            read until first accessed. File contents are held in
+            :data:`~letssync.structures.fsio.content_cache`, while parsed
+            data is kept on the node once it has been accessed.
+            (Only stored on the root)
         mode (int): The filesystem mode as reported by :func:`os.stat`
         modified (float): The last modified timestamp as reported by :func:`os.stat`
+        inode (int): The inode number as reported by :func:`os.stat`
+        size (int): The size in bytes as reported by :func:`os.stat`
+        content_hash (str): A hash of the data used for equality checks on
+            this node (not including children)
+        tree_hash (str): A Merkle hash of :attr:`content_hash` and the
+            :attr:`tree_hash` of all children
+        snapshot: A :class:`~letssync.structures.snapshot.Snapshot` of a
+            previous build to reuse unchanged data from. (Only stored on the
+            root and only while the tree is being built)
+        fs: The object used for filesystem access. This is normally the
+            :mod:`~letssync.structures.fsio` module, but may be replaced
+            by a :class:`~letssync.structures.fsio.ParallelScanner` while
+            the tree is being built. (Only stored on the root)
         serialize_attrs: (Class attribute) A :class:`list` of strings defining
             attributes used for serialization/deserialization
+        quick_check_attrs: (Class attribute) The attributes compared by
+            :meth:`quick_equal` when no others are given
+        serialize_fields: (Class attribute) A :class:`dict` mapping
+            attributes in :attr:`serialize_attrs` to the instance attributes
+            holding their values. Used to bypass properties whose getters
+            only return the stored value
     """
-    serialize_attrs = ['path', 'mode', 'id', 'modified']
+    serialize_attrs = ['path', 'mode', 'id', 'modified', 'inode', 'size']
+    serialize_fields = {'mode':'_mode'}
+    quick_check_attrs = ('size', 'modified')
+    __slots__ = (
+        'children', 'id', 'parent', '_mode', 'modified', 'inode', 'size',
+        '_root', '_path', '_relative_path', '_content_hash', '_tree_hash',
+        '_name', '_is_serialized', '_lazy', '_snapshot', '_fs', '_path_index',
+        '_dirty', '_mutable', '_clean_hash', '__weakref__',
+    )
     def __init__(self, **kwargs):
         self.children = {}
-        self.path = kwargs.get('path')
-        self.id = kwargs.get('id', self.path)
         self.parent = kwargs.get('parent')
+        path = kwargs.get('path')
+        self.id = intern_str(kwargs.get('id', path))
         if self.parent is None:
+            self._root = self
+            self.path = path
             self.is_serialized = kwargs.get('is_serialized', False)
+            self.lazy = kwargs.get('lazy', False)
+            self.snapshot = kwargs.get('snapshot')
+            self.fs = kwargs.get('fs')
+            self._path_index = {'':self}
+        else:
+            self._root = self.parent._root
+        # New nodes are dirty until the tree is found to match the filesystem
+        # (see finish_build)
+        self._mutable = 0
+        self._clean_hash = None
+        self._dirty = 0
+        self.mark_dirty()
         self.read(**kwargs)
         if self.is_serialized:
             self.deserialize_children(**kwargs)
         else:
             self.find_children()
-        if self.parent is None:
-            self.on_tree_built()
+        if self.parent is None and not kwargs.get('defer_tree_built'):
+            self.finish_build()
+    def finish_build(self):
+        """Called on the root once all nodes have been built
+
+        Calls :meth:`on_tree_built` and clears any state only needed during
+        the build. This is done automatically unless ``defer_tree_built``
+        was passed to the root (as done by :meth:`load`).
+        """
+        self.on_tree_built()
+        if not self.is_serialized:
+            self.mark_clean()
+        self.snapshot = None
+        self.fs = None
     def read(self, **kwargs):
         """Reads the necessary attributes from the filesystem
+
+        If a :class:`os.DirEntry` is given as ``dir_entry`` (as done by
+        :meth:`Directory.find_children`), its stat result is used so that
+        only one stat is performed per node.
         """
         self.name = kwargs.get('name')
         self.mode = kwargs.get('mode')
-        if self.mode is None:
-            self.mode = os.stat(self.path).st_mode
         self.modified = kwargs.get('modified')
-        if self.modified is None:
-            self.modified = os.stat(self.path).st_mtime
+        self.inode = kwargs.get('inode')
+        self.size = kwargs.get('size')
+        if self.mode is None or self.modified is None:
+            entry = kwargs.get('dir_entry')
+            if entry is not None:
+                st = self.fs.entry_stat(entry)
+            else:
+                st = self.fs.stat(self.path)
+            if self.mode is None:
+                self.mode = st.st_mode
+            if self.modified is None:
+                self.modified = st.st_mtime
+            if self.inode is None:
+                self.inode = st.st_ino
+            if self.size is None:
+                self.size = st.st_size
+    def get_snapshot_kwargs(self):
+        """Retrieves data that can be reused by a new build of this node
+        if its file has not changed (see :class:`~letssync.structures.snapshot.Snapshot`)
+
+        Returns:
+            dict: Keyword arguments to be passed to the new instance
+        """
+        return {}
     @property
     def name(self):
-        if self.parent is None:
-            return getattr(self, '_name', None)
-        return self.parent.name
+        return getattr(self._root, '_name', None)
     @name.setter
     def name(self, value):
         if self.parent is None:
             self._name = value
     @property
     def is_serialized(self):
-        return getattr(self.root, '_is_serialized', None)
+        return getattr(self._root, '_is_serialized', None)
     @is_serialized.setter
     def is_serialized(self, value):
         if self.parent is None:
             self._is_serialized = value
     @property
+    def lazy(self):
+        return getattr(self._root, '_lazy', False)
+    @lazy.setter
+    def lazy(self, value):
+        if self.parent is None:
+            self._lazy = value
+    @property
+    def snapshot(self):
+        return getattr(self._root, '_snapshot', None)
+    @snapshot.setter
+    def snapshot(self, value):
+        if self.parent is None:
+            self._snapshot = value
+    @property
+    def fs(self):
+        fs = getattr(self._root, '_fs', None)
+        if fs is None:
+            return fsio
+        return fs
+    @fs.setter
+    def fs(self, value):
+        if self.parent is None:
+            self._fs = value
+    @property
+    def mode(self):
+        return self._mode
+    @mode.setter
+    def mode(self, value):
+        self._mode = value
+        self.mark_dirty()
+    @property
+    def is_dirty(self):
+        if self._dirty != 0:
+            return True
+        if not self._mutable:
+            return False
+        # Look for mutable data changed in place
+        def visit(node):
+            if not node._mutable:
+                return WALK_SKIP
+            if node._get_dirty() & DIRTY_NODE:
+                return WALK_STOP
+        return not self.walk(visit)
+    @property
     def path(self):
-        return getattr(self, '_path', None)
+        root = self._root
+        if root is self:
+            return self._path
+        root_path = root._path
+        if root_path is None:
+            return None
+        return os.path.join(root_path, self.relative_path)
     @path.setter
     def path(self, value):
-        if value == self.path:
+        if self.parent is None:
+            prev = getattr(self, '_path', None)
+            self._path = value
+            if value != prev and getattr(self, '_dirty', None) is not None:
+                # Nothing has been written to the new location yet
+                self.mark_dirty(recursive=True)
+    @property
+    def content_hash(self):
+        h = getattr(self, '_content_hash', None)
+        if h is None or self._mutable & MUTABLE_NODE:
+            h = self._content_hash = self.calc_hash(self.get_hash_data())
+        return h
+    @property
+    def tree_hash(self):
+        h = getattr(self, '_tree_hash', None)
+        if h is None or self._mutable:
+            # Fill in any missing hashes from the bottom up. Those of nodes
+            # with mutable data (and their ancestors) are always calculated
+            def pre(node):
+                if not node._mutable and getattr(node, '_tree_hash', None) is not None:
+                    return WALK_SKIP
+            self.walk(pre, lambda node: node._calc_tree_hash())
+            h = self._tree_hash
+        return h
+    def _calc_tree_hash(self):
+        data = [self.content_hash]
+        for key in sorted(self.children.keys()):
+            data.extend([key, self.children[key]._tree_hash])
+        self._tree_hash = self.calc_hash(data)
+    @staticmethod
+    def calc_hash(data):
+        h = hashlib.sha256()
+        for s in data:
+            h.update(to_bytes(s))
+            h.update(b'\0')
+        return h.hexdigest()
+    def get_hash_data(self):
+        """Retrieves the values used to calculate :attr:`content_hash`
+
+        Subclasses should extend this with the values they use for
+        equality checks (:meth:`__eq__`)
+
+        Returns:
+            list: A :class:`list` of strings
+        """
+        return [self.__class__.__name__, self.relative_path]
+    def invalidate_hash(self):
+        """Clears the :attr:`content_hash` for this node and the
+        :attr:`tree_hash` for it and all of its ancestors
+
+        This is called automatically when attributes used in the hash are set,
+        but must be called manually if they are altered in place (unless the
+        node is marked by :meth:`mark_mutable`)
+        """
+        self._content_hash = None
+        self._tree_hash = None
+        obj = self.parent
+        while obj is not None:
+            if getattr(obj, '_tree_hash', None) is None:
+                break
+            obj._tree_hash = None
+            obj = obj.parent
+    def mark_mutable(self):
+        """Marks this node as holding data that may be changed in place
+        (such as parsed data handed out by a property)
+
+        The hashes of this node and its ancestors are then calculated each
+        time they are used instead of being stored, since no setter is
+        called when the data is changed. :meth:`write` also compares the
+        :attr:`content_hash` with the one found when the node was last
+        written (or read) to find these changes. Its ancestors are marked
+        with :data:`MUTABLE_CHILDREN`.
+        """
+        if self._mutable & MUTABLE_NODE:
+            return
+        self._mutable |= MUTABLE_NODE
+        if not self._dirty & DIRTY_NODE:
+            # Not changed yet, so it still matches the filesystem
+            self._record_clean_hash()
+        obj = self.parent
+        while obj is not None:
+            if obj._mutable & MUTABLE_CHILDREN:
+                break
+            obj._mutable |= MUTABLE_CHILDREN
+            obj = obj.parent
+    def mark_dirty(self, recursive=False):
+        """Marks this node as changed so it is written by :meth:`write`
+
+        Its ancestors are marked with :data:`DIRTY_CHILDREN` so that
+        :meth:`write` can find it. This is called automatically when
+        written attributes are set, but must be called manually if they are
+        altered in place (unless the node is marked by :meth:`mark_mutable`)
+
+        Arguments:
+            recursive (bool): If :const:`True`, all descendants are marked
+                as well. default is :const:`False`
+        """
+        if recursive:
+            def visit(node):
+                node._dirty = DIRTY_NODE | DIRTY_CHILDREN
+            self.walk(visit)
+        else:
+            self._dirty |= DIRTY_NODE
+        obj = self.parent
+        while obj is not None:
+            if obj._dirty & DIRTY_CHILDREN:
+                break
+            obj._dirty |= DIRTY_CHILDREN
+            obj = obj.parent
+    def mark_clean(self, recursive=True):
+        """Marks this node (and by default its descendants) as matching
+        the filesystem
+
+        Arguments:
+            recursive (bool): default is :const:`True`
+        """
+        if not recursive:
+            self._dirty &= ~DIRTY_NODE
+            self._record_clean_hash()
             return
-        self._path = value
-        for child in self.children.values():
-            child.update_path()
+        def visit(node):
+            if not node._dirty and not node._mutable:
+                return WALK_SKIP
+            node._dirty = 0
+            node._record_clean_hash()
+        self.walk(visit)
+    def _record_clean_hash(self):
+        # Stores the hash of mutable data matching the filesystem so that
+        # changes made in place can be found (see _get_dirty)
+        if self._mutable & MUTABLE_NODE:
+            self._clean_hash = self.content_hash
+    def _get_dirty(self):
+        # The dirty flags including any changes made to mutable data in place
+        dirty = self._dirty
+        mutable = self._mutable
+        if mutable & MUTABLE_NODE and not dirty & DIRTY_NODE:
+            if self.content_hash != self._clean_hash:
+                dirty |= DIRTY_NODE
+        if mutable & MUTABLE_CHILDREN:
+            dirty |= DIRTY_CHILDREN
+        return dirty
     @property
     def root(self):
-        if self.parent is None:
-            return self
-        return self.parent.root
+        """The root node of the tree
+
+        This is stored on each node when it is added to the tree, so no
+        search is needed
+        """
+        return self._root
     @property
     def relative_path(self):
         """The node's path relative to its root
@@ -96,55 +550,63 @@ class Path(object):
     @classmethod
     def get_serialize_attrs(cls):
         """Retrieves :attr:`Path.serialize_attrs` for serialization
-        All members (subclasses and base classes) are searched.
-        """
-        def iter_bases(_cls=None):
-            if _cls is None:
-                _cls = cls
-            yield _cls
-            for base_cls in _cls.__bases__:
-                if not issubclass(base_cls, Path):
-                    continue
-                if base_cls is object:
-                    continue
-                for _cls_ in iter_bases(base_cls):
-                    yield _cls_
-        attrs = set()
-        for _cls in iter_bases():
-            if 'serialize_attrs' not in _cls.__dict__:
-                continue
-            attrs |= set(_cls.serialize_attrs)
-        return attrs
+        All members (subclasses and base classes) are included, with those
+        of base classes first.
+
+        This is computed once per class by :class:`PathMeta`
+
+        Returns:
+            tuple: The attribute names
+        """
+        return cls._serialize_attrs
     @classmethod
     def find_subclass(cls, name):
-        def search(cls):
-            if cls.__name__ == name:
-                return cls
-            for _cls in cls.__subclasses__():
-                r = search(_cls)
-                if r is not None:
-                    return r
-            return None
-        return search(Path)
+        """Finds a subclass of :class:`Path` by name using
+        :attr:`PathMeta.registry`
+
+        Returns:
+            The class if found, otherwise :const:`None`
+        """
+        return PathMeta.registry.get(name)
     @classmethod
-    def _child_class_override(cls, child_class, **kwargs):
-        """Allows subclasses to override the class to use before a child is built
+    def get_override_chain(cls):
+        """Retrieves the :meth:`_child_class_override` methods to be called
+        when a child of this class is added
+
+        These are the overrides defined by the classes at the ends of the
+        subclass hierarchy below this class (most recently defined first).
+        The result is computed once and stored in :class:`PathMeta` until
+        another subclass is defined.
+
+        Returns:
+            tuple: The bound :meth:`_child_class_override` methods
         """
-        def get_last_cls(_cls=None):
-            if _cls is None:
-                _cls = cls
-            if not len(_cls.__subclasses__()):
+        chain = PathMeta.override_chains.get(cls)
+        if chain is not None:
+            return chain
+        def get_last_cls(_cls):
+            subclasses = _cls.__subclasses__()
+            if not len(subclasses):
                 yield _cls
-                raise StopIteration()
-            for subcls in _cls.__subclasses__():
+                return
+            for subcls in subclasses:
                 for last_cls in get_last_cls(subcls):
                     yield last_cls
-        for _cls in reversed(list(get_last_cls())):
+        chain = []
+        for _cls in reversed(list(get_last_cls(cls))):
             if '_child_class_override' not in _cls.__dict__:
                 continue
             if _cls is cls:
                 continue
-            _child_class = _cls._child_class_override(child_class, **kwargs)
+            chain.append(_cls._child_class_override)
+        chain = PathMeta.override_chains[cls] = tuple(chain)
+        return chain
+    @classmethod
+    def _child_class_override(cls, child_class, **kwargs):
+        """Allows subclasses to override the class to use before a child is built
+        """
+        for override in cls.get_override_chain():
+            _child_class = override(child_class, **kwargs)
             if _child_class is not None:
                 return _child_class
         return child_class
@@ -160,36 +622,90 @@ class Path(object):
         _cls = cls.find_subclass(d['class_name'])
         d['is_serialized'] = True
         return _cls(**d)
+    @classmethod
+    def load(cls, fp):
+        """Builds an entire tree from a file object containing JSON
+        (as written by :meth:`dump` or :meth:`to_json`)
+
+        Nodes are built as they are parsed, so the complete data structure
+        is never held in memory.
+        See :mod:`letssync.structures.jsonstream`
+
+        Returns:
+            Path: An instance of :class:`Path` or one of its subclasses
+        """
+        from letssync.structures import jsonstream
+        return jsonstream.load(fp)
+    @classmethod
+    def from_binary(cls, data):
+        """Builds an entire tree from a binary snapshot
+        (see :mod:`letssync.structures.binary`)
+        """
+        from letssync.structures import binary
+        return binary.loads(data)
+    def to_binary(self, compress=True):
+        """Serializes the entire tree into a binary snapshot with
+        deduplicated file contents (see :mod:`letssync.structures.binary`)
+
+        Returns:
+            bytes
+        """
+        from letssync.structures import binary
+        return binary.dumps(self, compress)
+    def get_manifest(self):
+        """Builds a :class:`~letssync.structures.manifest.Manifest`
+        for the tree
+        """
+        from letssync.structures.manifest import Manifest
+        return Manifest.from_tree(self)
+    @property
+    def path_index(self):
+        """A :class:`dict` of every node in the tree with their
+        :attr:`relative_path` as keys (stored on the root)
+        """
+        root = self.root
+        idx = getattr(root, '_path_index', None)
+        if idx is None:
+            idx = root._path_index = {}
+            for node in root.iter_subtree():
+                idx[node.relative_path] = node
+        return idx
+    def walk(self, pre=None, post=None):
+        """Visits this node and all of its descendants without recursion
+
+        See :func:`walk_tree`
+        """
+        return walk_tree(self, pre, post)
+    def iter_subtree(self):
+        """Iterates over this node and all of its descendants (parents first)
+        """
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(list(node.children.values())))
     def search(self, path):
         """Search for the given path relative to the instance
 
+        This is a single lookup in :attr:`path_index`
+
         Returns:
             Path: An instance of :class:`Path` or one of its subclasses if found,
                 otherwise :const:`None`
         """
-        if not isinstance(path, list):
-            path = path.split(os.sep)
-        key = path[0]
-        try:
-            path = path[1:]
-        except IndexError:
-            path = None
-        child = self.children.get(key)
-        if child is not None:
-            if not path:
-                return child
-            else:
-                return child.search(path)
-        else:
+        if isinstance(path, list):
+            path = os.path.join(*path) if len(path) else ''
+        if not path:
             return None
+        rel_path = self.relative_path
+        if rel_path:
+            path = os.path.join(rel_path, path)
+        return self.path_index.get(path)
     def update_path(self):
-        """Resets the :attr:`Path.path` for this instance relative to its parent
-        Called automatically by the parent when its path has been alterered
-        (resulting in a recursive update for the entire tree)
+        """Kept for compatibility. :attr:`Path.path` is derived from the
+        root, so there is nothing to update
         """
-        root_path = self.root.path
-        new_path = os.path.join(root_path, self.relative_path)
-        self.path = new_path
+        pass
     def find_children(self):
         """Used by subclasses to build the tree structure from the filesystem
         """
@@ -206,34 +722,144 @@ class Path(object):
         if not self.is_serialized:
             cls = cls._child_class_override(cls, **kwargs)
         child = cls(**kwargs)
-        self.children[child.id] = child
+        self._replace_child(child)
+        idx = getattr(self.root, '_path_index', None)
+        if idx is not None:
+            idx[child.relative_path] = child
+        self.invalidate_hash()
         return child
     def add_existing_child(self, child):
         """Adds an existing instance of :class:`Path` as a child
         Sets appropriate attribtes on the child object to incorporate it
         into the tree
         """
-        child._relative_path = None
+        if child.parent is None:
+            child._path_index = None
+        else:
+            child._unindex_subtree()
         child.parent = self
-        self.children[child.id] = child
-        child.update_path()
+        self._replace_child(child)
+        child._reset_subtree()
+        idx = getattr(self.root, '_path_index', None)
+        if idx is not None:
+            for node in child.iter_subtree():
+                idx[node.relative_path] = node
+        self.invalidate_hash()
+        # The subtree has not been written at its new location
+        child.mark_dirty(recursive=True)
+        return child
+    def remove_child(self, key):
+        """Removes the child with the given :attr:`id` from the tree
+
+        Returns:
+            Path: The removed child
+        """
+        child = self.children[key]
+        child._unindex_subtree()
+        del self.children[key]
+        self.invalidate_hash()
         return child
+    def _replace_child(self, child):
+        existing = self.children.get(child.id)
+        if existing is not None and existing is not child:
+            existing._unindex_subtree()
+        self.children[child.id] = child
+    def _unindex_subtree(self):
+        idx = getattr(self.root, '_path_index', None)
+        if idx is None:
+            return
+        for node in self.iter_subtree():
+            if idx.get(node.relative_path) is node:
+                del idx[node.relative_path]
+    def _reset_subtree(self):
+        # Propagate the root and relative paths after a move
+        # (parents are always visited before their children)
+        root = self.parent._root
+        for node in self.iter_subtree():
+            node._root = root
+            node._relative_path = os.path.join(node.parent.relative_path, node.id)
+            node._content_hash = None
+            node._tree_hash = None
+    def update_attrs(self, **kwargs):
+        """Sets serialized attributes on an existing instance
+        (used when applying a delta from :meth:`get_delta`)
+        """
+        for key, val in kwargs.items():
+            if key in ['path', 'id', 'name', 'class_name', 'children']:
+                continue
+            setattr(self, key, val)
+    def get_delta(self, base):
+        """Finds the changes made to the tree since an earlier snapshot
+
+        Arguments:
+            base: The earlier tree, or any snapshot source accepted by
+                :meth:`letssync.structures.snapshot.Snapshot.load`
+
+        Returns:
+            dict: A delta that can be passed to :meth:`apply_delta`
+            (see :mod:`letssync.structures.delta`)
+        """
+        from letssync.structures import delta
+        return delta.get_delta(self, base)
+    def apply_delta(self, d, verify=True):
+        """Applies a delta from :meth:`get_delta` to this (deserialized) tree
+
+        See :func:`letssync.structures.delta.apply_delta`
+        """
+        from letssync.structures import delta
+        return delta.apply_delta(self, d, verify)
+    def merge(self, base, other, check_modes=True):
+        """Performs a three-way merge of this tree (side ``'a'``) and
+        another (side ``'b'``) using a common ancestor
+
+        See :func:`letssync.structures.merge.merge`
+
+        Returns:
+            MergePlan: A :class:`~letssync.structures.merge.MergePlan`
+        """
+        from letssync.structures import merge
+        return merge.merge(base, self, other, check_modes)
+    def get_sync_plan(self, dest, root_path=None, check_modes=True):
+        """Plans the filesystem operations needed to make another tree
+        (usually built from the destination) match this one
+
+        See :func:`letssync.structures.sync.plan_sync`
+
+        Returns:
+            SyncPlan: A :class:`~letssync.structures.sync.SyncPlan`
+        """
+        from letssync.structures import sync
+        return sync.plan_sync(self, dest, root_path, check_modes)
     def to_json(self):
         """Serializes the entire tree into a JSON string
         """
         d = self.root.serialize()
         return json.dumps(d, indent=2)
+    def dump(self, fp, indent=None):
+        """Writes the entire tree as JSON to a file object one node at a time
+
+        Arguments:
+            fp: A file object opened in text mode
+            indent (int): If given, the output is indented by this amount.
+                Otherwise a compact form is written
+        """
+        from letssync.structures import jsonstream
+        jsonstream.dump(self.root, fp, indent)
     def serialize(self):
         """Retrieves all data needed for serialization, including children
 
         Returns:
             dict: A :class:`dict` containing all data to be serialized
         """
-        d = self._serialize()
-        d['children'] = {}
-        for key, val in self.children.items():
-            d['children'][key] = val.serialize()
-        return d
+        result = {}
+        def visit(node):
+            d = node._serialize()
+            d['children'] = {}
+            result[id(node)] = d
+            if node is not self:
+                result[id(node.parent)]['children'][node.id] = d
+        self.walk(visit)
+        return result[id(self)]
     def _serialize(self):
         """Retrieves serialization data for this instance only
 
@@ -241,8 +867,7 @@ class Path(object):
             dict: A :class:`dict` with the instance's attribtes/values
                 and the class name
         """
-        attrs = self.get_serialize_attrs()
-        d = {attr: getattr(self, attr) for attr in attrs}
+        d = dict(zip(self._serialize_attrs, self._serialize_getter(self)))
         d['class_name'] = self.__class__.__name__
         if self.parent is None:
             d['name'] = self.name
@@ -256,74 +881,227 @@ class Path(object):
             cls = self.find_subclass(val['class_name'])
             self.add_child(cls, **val)
     def on_tree_built(self):
-        """Called (recursively) by the tree root after all children have been built
-        Used for operations that depend on other objects to exist in the tree
+        """Called by the tree root after all children have been built
+        This calls :meth:`_on_tree_built` for this node and its descendants
         """
-        for child in self.children.values():
-            child.on_tree_built()
-    def write(self, overwrite=False, recursive=True):
+        self.walk(lambda node: node._on_tree_built())
+    def _on_tree_built(self):
+        """Used by subclasses for operations that depend on other objects
+        to exist in the tree
+        """
+        pass
+    def write(self, overwrite=False, recursive=True, fsync=True, workers=None):
         """Write the objects in the tree to their given paths
 
+        Only nodes marked as dirty (see :meth:`mark_dirty`) or with mutable
+        data changed in place (see :meth:`mark_mutable`) are written and
+        subtrees without changes are skipped entirely. Nodes are marked clean
+        once written.
+
+        Files and links are replaced atomically and the directories written
+        to are synced once all nodes are written
+        (see :class:`~letssync.structures.fsio.BatchWriter`).
+
         Arguments:
             overwrite (bool): If :const:`True`, any existing files are allowed
                 to be overwritten
             recursive (bool): default is :const:`True`
+            fsync (bool): If :const:`False`, the writes are not synced to
+                disk. default is :const:`True`
+            workers (int): If given, the nodes are written using this many
+                threads (see :class:`~letssync.structures.fsio.WriteExecutor`).
+                Each node is written after its parent directory and links are
+                written after the nodes they point to
         """
-        self._write(overwrite)
-        if recursive:
-            for child in self.children.values():
-                child.write(overwrite, recursive)
-    def _write(self, overwrite=False):
+        with fsio.BatchWriter(fsync) as writer:
+            if not recursive:
+                if self._get_dirty() & DIRTY_NODE and self._write(overwrite, writer) is not False:
+                    self.mark_clean(recursive=False)
+                return
+            if workers is not None:
+                self._write_parallel(overwrite, writer, workers)
+                return
+            def visit(node):
+                dirty = node._get_dirty()
+                if not dirty:
+                    return WALK_SKIP
+                node._dirty = 0
+                if not dirty & DIRTY_NODE:
+                    return
+                try:
+                    r = node._write(overwrite, writer)
+                except Exception:
+                    node.mark_dirty()
+                    raise
+                if r is False:
+                    # Left unwritten (the path exists), so keep it dirty
+                    node.mark_dirty()
+                else:
+                    node._record_clean_hash()
+            self.walk(visit)
+    def _write_parallel(self, overwrite, writer, workers):
+        executor = fsio.WriteExecutor(workers)
+        nodes = {}
+        def visit(node):
+            dirty = node._get_dirty()
+            if not dirty:
+                return WALK_SKIP
+            node._dirty = 0
+            if dirty & DIRTY_NODE:
+                key = node.relative_path
+                nodes[key] = node
+                executor.add(key, node._write, (overwrite, writer), node._get_write_depends())
+        self.walk(visit)
+        try:
+            executor.run()
+        finally:
+            # Nodes left unwritten are marked again (from this thread only)
+            for key, node in nodes.items():
+                if executor.results.get(key, False) is False:
+                    node.mark_dirty()
+                else:
+                    node._record_clean_hash()
+    def _get_write_depends(self):
+        """The relative paths of the nodes that must be written before this
+        one (when writing in parallel)
+        """
+        if self.parent is None:
+            return []
+        return [self.parent.relative_path]
+    def _write(self, overwrite=False, writer=fsio):
         """Used by subclasses to handle the write operation
+
+        Arguments:
+            overwrite (bool)
+            writer: The :class:`~letssync.structures.fsio.BatchWriter` to use.
+                If not given, the :mod:`~letssync.structures.fsio` module
+                functions are used (syncing each write right away)
+
+        Returns:
+            :const:`False` if nothing was written because the path exists
         """
         raise NotImplementedError('Must be defined by subclasses')
     def copy(self, root_path=None):
         """Creates a 'deep' copy of this node (including children)
 
+        The new nodes share file contents, computed hashes and parsed data
+        with the originals instead of serializing and rebuilding the tree.
+        Shared parsed data (such as
+        :attr:`~letssync.structures.account.AccountFile.data`) is copied by
+        the new node when it is first accessed, so changes made to one
+        tree never affect the other.
+
         Arguments:
             root_path (str): If set, sets a new root path for the copied object
 
         Returns:
             Path: The newly copied instance of :class:`Path`
         """
-        kwargs = self.serialize()
-        kwargs['is_serialized'] = True
-        new_obj = self.__class__(**kwargs)
+        new_obj = self._clone(None, self.parent is None)
+        new_obj._is_serialized = True
+        new_obj._lazy = False
+        new_obj.on_tree_built()
         if root_path is not None:
             p = self.relative_path
             new_obj.path = os.path.join(root_path, p)
         return new_obj
-    def get_diff(self, other, other_name=None):
-        if self.parent is None:
-            if self.name is None:
-                self.root.name = str(id(self.root))
-            if other.name is None:
-                other.root.name = str(id(other.root))
-        if other_name is None:
-            other_name = other.name
-        d = {}
-        if self == other:
-            diff = {}
+    def _clone(self, parent, keep_hashes):
+        cls = self.__class__
+        obj = cls.__new__(cls)
+        for attr in cls._slot_attrs:
+            try:
+                setattr(obj, attr, getattr(self, attr))
+            except AttributeError:
+                pass
+        d = getattr(self, '__dict__', None)
+        if d:
+            obj.__dict__.update(d)
+        obj.parent = parent
+        if parent is None:
+            obj._root = obj
+            obj._path = self.path
         else:
-            diff = self._get_diff(other, other_name)
-        if diff:
-            d[self.relative_path] = diff
+            obj._root = parent._root
+        obj.children = {}
+        obj._path_index = None
+        obj._mutable = 0
+        if not keep_hashes or self._mutable:
+            # Hashes of mutable data may be outdated
+            obj._relative_path = None
+            obj._content_hash = None
+            obj._tree_hash = None
+        obj._clone_attrs(self)
         for key, child in self.children.items():
-            if other is None:
-                other_child = None
-            else:
-                other_child = other.children.get(key)
-            _d = child.get_diff(other_child, other_name)
-            if len(_d):
-                d.update(_d)
-        if other is not None:
-            for key, other_child in other.children.items():
-                if key in self.children:
-                    continue
-                _d = other_child.get_diff(None, self.name)
-                if len(_d):
-                    d.update(_d)
+            obj.children[key] = child._clone(obj, keep_hashes)
+        obj._post_clone()
+        return obj
+    def _clone_attrs(self, source):
+        """Called by :meth:`copy` on each new node (before its children
+        are copied) to set any attributes that should not be shared with
+        the source node
+        """
+        pass
+    def _post_clone(self):
+        """Called by :meth:`copy` on each new node after its children have
+        been copied
+        """
+        pass
+    def get_diff(self, other, other_name=None, quick_check=False):
+        """Compares this node and its descendants with another tree
+
+        Arguments:
+            other: The node to compare against
+            other_name (str): The name to use for the ``other`` tree
+                (see :func:`letssync.structures.diff.iter_diff`)
+            quick_check: If set, nodes matching :meth:`quick_equal` are not
+                compared further (see :meth:`is_equal`)
+
+        Returns:
+            dict: The relative paths of each differing node as keys with
+            the differences found by :meth:`_get_diff` as values
+        """
+        d = {}
+        for change in self.iter_diff(other, other_name, quick_check):
+            d[change.relative_path] = change.get_diff()
         return d
+    def iter_diff(self, other, other_name=None, quick_check=False):
+        """Compares this node and its descendants with another tree,
+        yielding each difference as it is found
+
+        See :func:`letssync.structures.diff.iter_diff`
+        """
+        from letssync.structures import diff
+        return diff.iter_diff(self, other, other_name, quick_check)
+    def node_equal(self, other):
+        """Checks whether another node matches this one, not including
+        their children
+
+        The :attr:`content_hash` values are compared first, so
+        :meth:`_diff_attrs` is only used if they differ.
+        """
+        if self.__class__ is not other.__class__:
+            return False
+        if self.content_hash == other.content_hash:
+            return True
+        return len(self._diff_attrs(other)) == 0
+    def mode_equal(self, other):
+        """Checks whether the permission bits of another node match this one
+
+        The :attr:`mode` is not part of :meth:`node_equal` (or the hashes),
+        so this is used alongside it where permission changes matter
+        """
+        if self.mode is None or other.mode is None:
+            return self.mode is other.mode
+        return stat.S_IMODE(self.mode) == stat.S_IMODE(other.mode)
+    def _diff_attrs(self, other):
+        """Finds the names of the attributes reported by :meth:`_get_diff`
+        without building their values
+
+        Subclasses extending :meth:`_get_diff` should extend this to match
+        """
+        if self.relative_path != other.relative_path:
+            return ['relative_path']
+        return []
     def _get_diff(self, other, other_name):
         d = {}
         if other is None:
@@ -335,26 +1113,89 @@ class Path(object):
         if self_p != other_p:
             d['relative_path'] = {self.name:self_p, other_name:other_p}
         return d
-    def is_equal(self, other, recursive=True):
+    def is_equal(self, other, recursive=True, metadata_only=False, quick_check=False):
         """Used to perform equality checking, typically for recursive checks
 
         Arguments:
             other: :class:`Path` instance
             recursive (bool): default is :const:`True`
+            metadata_only (bool): If :const:`True`, compare using
+                :meth:`meta_equal` so that no file contents are accessed.
+                default is :const:`False`
+            quick_check: If :const:`True` (or a sequence of attribute names),
+                nodes are considered equal when :meth:`quick_equal` matches
+                and are only compared in full (:meth:`__eq__`) otherwise.
+                default is :const:`False`
         Returns:
             bool: True if equal
+
+        Unless ``metadata_only`` or ``quick_check`` is used, nodes with
+        matching hashes (:attr:`tree_hash` or :attr:`content_hash`) are
+        considered equal without further comparison. With ``quick_check``,
+        this is only done for hashes that have already been computed.
         """
-        if self != other:
-            return False
+        quick_attrs = None if quick_check is True else quick_check
+        def visit(item):
+            node, other = item
+            if metadata_only:
+                if not node.meta_equal(other):
+                    return WALK_STOP
+            elif quick_check:
+                if recursive and node._cached_hash_equal(other):
+                    return WALK_SKIP
+                if not node.quick_equal(other, quick_attrs) and node != other:
+                    return WALK_STOP
+            elif isinstance(other, Path) and node._hash_equal(other, recursive):
+                return WALK_SKIP
+            elif node != other:
+                return WALK_STOP
+            if recursive:
+                for key in node.children:
+                    if key not in other.children:
+                        return WALK_STOP
+        def get_children(item):
+            if not recursive:
+                return []
+            node, other = item
+            return [(child, other.children[key]) for key, child in node.children.items()]
+        return walk_tree((self, other), visit, get_children=get_children)
+    def _hash_equal(self, other, recursive=True):
         if recursive:
-            for key, child in self.children.items():
-                other_child = other.children.get(key)
-                if other_child is None:
-                    return False
-                r = child.is_equal(other_child, recursive=True)
-                if not r:
-                    return False
-        return True
+            return self.tree_hash == other.tree_hash
+        return self.content_hash == other.content_hash
+    def _cached_hash_equal(self, other):
+        # Compares tree hashes only if neither needs to be calculated
+        h = getattr(self, '_tree_hash', None)
+        if h is None or self._mutable or getattr(other, '_mutable', 0):
+            return False
+        return h == getattr(other, '_tree_hash', None)
+    def quick_equal(self, other, attrs=None):
+        """Checks whether a node can be assumed equal to another using
+        only filesystem metadata (similar to the "quick check" in rsync)
+
+        This is only done for nodes whose comparison would read file
+        contents (such as :class:`FileObjBase`), so this returns
+        :const:`False` for all others.
+
+        Arguments:
+            other: :class:`Path` instance
+            attrs: The attribute names to compare. If not given,
+                :attr:`quick_check_attrs` is used
+
+        Returns:
+            bool: :const:`True` if the nodes can be assumed equal. If
+            :const:`False`, they must be compared in full
+        """
+        return False
+    def meta_equal(self, other):
+        """Checks equality using only filesystem metadata
+        (class, relative path, mode and modified time)
+        """
+        if not isinstance(other, self.__class__):
+            return False
+        if other.relative_path != self.relative_path:
+            return False
+        return self.mode == other.mode and self.modified == other.modified
     def __eq__(self, other):
         if not isinstance(other, self.__class__):
             return False
@@ -373,42 +1214,70 @@ class Directory(Path):
     """Represents a filesystem directory
     This is the main starting point for building a tree with a given path
     """
-    def add_subdirectory(self, fn, cls=None):
+    __slots__ = ()
+    def add_subdirectory(self, fn, cls=None, **kwargs):
         if cls is None:
             cls = Directory
         if os.path.dirname(fn) != self.path:
             fn = os.path.join(self.path, fn)
-        return self.add_child(cls, path=fn)
-    def add_file(self, fn, cls=None):
+        return self.add_child(cls, path=fn, **kwargs)
+    def add_file(self, fn, cls=None, **kwargs):
         if cls is None:
             cls = FileObj
         if os.path.dirname(fn) != self.path:
             fn = os.path.join(self.path, fn)
-        return self.add_child(cls, path=fn)
-    def add_link(self, fn, cls=None):
+        return self.add_child(cls, path=fn, **kwargs)
+    def add_link(self, fn, cls=None, **kwargs):
         if cls is None:
             cls = Link
         if os.path.dirname(fn) != self.path:
             fn = os.path.join(self.path, fn)
-        return self.add_child(cls, path=fn)
+        return self.add_child(cls, path=fn, **kwargs)
     def add_child(self, cls, **kwargs):
         kwargs.setdefault('id', os.path.basename(kwargs.get('path')))
         return super(Directory, self).add_child(cls, **kwargs)
     def find_children(self):
-        for fn in os.listdir(self.path):
-            p = os.path.join(self.path, fn)
-            if os.path.isdir(p):
-                self.add_subdirectory(p)
-            elif os.path.islink(p):
-                self.add_link(p)
-            elif os.path.isfile(p):
-                self.add_file(p)
-    def _write(self, overwrite=False):
+        """Builds children from the directory contents using :func:`os.scandir`
+
+        The entry types are taken from the :class:`os.DirEntry` objects and
+        each entry is passed to its child so its stat result can be reused.
+        If the tree is being built with a :attr:`~Path.snapshot`, data for
+        unchanged entries is taken from it.
+        """
+        snapshot = self.snapshot
+        fs = self.fs
+        for entry in fs.scandir(self.path):
+            p = entry.path
+            kwargs = {'dir_entry':entry}
+            if snapshot is not None:
+                rel_path = os.path.join(self.relative_path, entry.name)
+                st = fs.entry_stat(entry)
+                kwargs.update(snapshot.get_kwargs(rel_path, st))
+            if entry.is_dir():
+                self.add_subdirectory(p, **kwargs)
+            elif entry.is_symlink():
+                self.add_link(p, **kwargs)
+            elif entry.is_file():
+                self.add_file(p, **kwargs)
+    def _write(self, overwrite=False, writer=fsio):
         p = self.path
         if os.path.exists(p):
-            return
-        os.makedirs(p)
-        os.chmod(p, self.mode)
+            # The directory's contents are its children (written separately)
+            # so only the mode is left to update
+            if overwrite is False:
+                return
+            writer.chmod(p, self.mode)
+        else:
+            writer.makedirs(p, self.mode)
+    def get_hash_data(self):
+        data = super(Directory, self).get_hash_data()
+        data.extend(sorted(self.children.keys()))
+        return data
+    def meta_equal(self, other):
+        r = super(Directory, self).meta_equal(other)
+        if not r:
+            return r
+        return set(self.children.keys()) == set(other.children.keys())
     def __eq__(self, other):
         r = super(Directory, self).__eq__(other)
         if not r:
@@ -421,41 +1290,127 @@ class FileObjBase(Path):
 
     Attributes:
         content (str): The file content.
-            If not given, the file given by :attr:`Path.path` will be read
+            If not given, the file given by :attr:`Path.path` will be read.
+            If the tree is :attr:`~Path.lazy`, this is done on first access.
+            Copies of nodes whose content was not loaded read it from the
+            source node's path instead (see :meth:`Path.copy`)
     """
+    __slots__ = ('_content', '_content_path')
     def read(self, **kwargs):
         super(FileObjBase, self).read(**kwargs)
         self.content = kwargs.get('content')
-        if self.content is None:
-            with open(self.path, 'r') as f:
-                self.content = f.read()
-    def _write(self, overwrite=False):
+        if not self.lazy:
+            self.content
+    @property
+    def content(self):
+        c = getattr(self, '_content', None)
+        if c is None:
+            c = self.load_content()
+        return c
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._content_path = None
+        self.invalidate_hash()
+        self.mark_dirty()
+    def load_content(self):
+        """Reads the file content from :attr:`Path.path`
+
+        For :attr:`~Path.lazy` trees, the content is held in the bounded
+        :data:`~letssync.structures.fsio.content_cache` (and may be read again
+        if dropped). Otherwise it is stored on the instance.
+        """
+        p = getattr(self, '_content_path', None) or self.path
+        if not self.lazy:
+            self._content = self.fs.read_file(p)
+            self._content_path = None
+            return self._content
+        c = fsio.content_cache.get(self, 'content')
+        if c is None:
+            c = self.fs.read_file(p)
+            fsio.content_cache.set(self, 'content', c)
+        return c
+    def _clone_attrs(self, source):
+        super(FileObjBase, self)._clone_attrs(source)
+        if getattr(source, '_content', None) is None:
+            # Not loaded yet, so it is read from the source location when
+            # first needed (this still works once the copy is re-rooted)
+            self._content_path = getattr(source, '_content_path', None) or source.path
+    def quick_equal(self, other, attrs=None):
+        """Checks the class, relative path and the given attributes
+        (size and modified time by default). Missing values never match
+        """
+        if not isinstance(other, self.__class__):
+            return False
+        if other.relative_path != self.relative_path:
+            return False
+        if attrs is None:
+            attrs = self.quick_check_attrs
+        for attr in attrs:
+            val = getattr(self, attr)
+            if val is None or val != getattr(other, attr):
+                return False
+        return True
+    def get_snapshot_kwargs(self):
+        kwargs = super(FileObjBase, self).get_snapshot_kwargs()
+        c = getattr(self, '_content', None)
+        if c is not None:
+            kwargs['content'] = c
+        return kwargs
+    def get_file_content(self):
+        """Retrieves the content to be written to the file
+
+        Returns:
+            str
+        """
+        return self.content
+    def _write(self, overwrite=False, writer=fsio):
         p = self.path
         if os.path.exists(p) and overwrite is False:
-            return
-        with open(p, 'w') as f:
-            f.write(self.content)
-        os.chmod(p, self.mode)
+            return False
+        writer.write_file(p, self.get_file_content(), self.mode)
 
 class FileObj(FileObjBase):
     """Represents an actual file (not a symlink)
     File contents are only serialized by default in this class
+
+    Attributes:
+        max_diff_size (int): (Class attribute) The size limit used for
+            text diffs of the content (see :mod:`letssync.structures.diff`).
+            If :const:`None`, diffs are not limited. default is 65536
     """
     serialize_attrs = ['content']
+    max_diff_size = 65536
+    __slots__ = ()
+    def get_hash_data(self):
+        data = super(FileObj, self).get_hash_data()
+        data.append(self.content)
+        return data
+    def _diff_attrs(self, other):
+        attrs = super(FileObj, self)._diff_attrs(other)
+        if self.content != other.content:
+            attrs.append('content')
+        return attrs
     def _get_diff(self, other, other_name):
         d = super(FileObj, self)._get_diff(other, other_name)
         if other is None:
             return d
         if self.content != other.content:
-            d['content'] = {self.name:self.content, other_name:other.content}
-            diffgen = difflib.unified_diff(
-                self.content.splitlines(),
-                other.content.splitlines(),
-                self.name,
-                other_name,
-            )
-            d['content']['diff'] = '\n'.join(diffgen)
+            content_diff = self._get_content_diff(other, other_name)
+            if content_diff is not None:
+                d['content'] = content_diff
         return d
+    def _get_content_diff(self, other, other_name):
+        """Builds the ``content`` entry for :meth:`_get_diff` using
+        :func:`letssync.structures.diff.get_content_diff`
+
+        Subclasses may return :const:`None` to omit it
+        """
+        from letssync.structures import diff
+        return diff.get_content_diff(
+            self.content, other.content, self.name, other_name,
+            self.max_diff_size,
+        )
     def __eq__(self, other):
         r = super(FileObj, self).__eq__(other)
         if not r:
@@ -471,11 +1426,33 @@ class Link(FileObjBase):
         linked_obj: A reference to the linked :class:`FileObj` instance
     """
     serialize_attrs = ['linked_path']
+    serialize_fields = {'linked_path':'_linked_path'}
+    __slots__ = ('_linked_path', 'linked_obj')
     def read(self, **kwargs):
         super(Link, self).read(**kwargs)
         self.linked_path = kwargs.get('linked_path')
         if self.linked_path is None:
-            self.linked_path = os.readlink(self.path)
+            self.linked_path = self.fs.readlink(self.path)
+    def get_snapshot_kwargs(self):
+        kwargs = super(Link, self).get_snapshot_kwargs()
+        kwargs['linked_path'] = self.linked_path
+        return kwargs
+    @property
+    def linked_path(self):
+        return self._linked_path
+    @linked_path.setter
+    def linked_path(self, value):
+        self._linked_path = value
+        self.invalidate_hash()
+        self.mark_dirty()
+    def _clone_attrs(self, source):
+        # Avoid FileObjBase since a link has no content of its own
+        # (linked_obj is set by on_tree_built)
+        self.linked_obj = None
+    def get_hash_data(self):
+        data = super(Link, self).get_hash_data()
+        data.append(self.linked_path)
+        return data
     @property
     def content(self):
         obj = getattr(self, 'linked_obj', None)
@@ -489,27 +1466,51 @@ class Link(FileObjBase):
         obj = getattr(self, 'linked_obj', None)
         if obj is not None:
             obj.content = value
-    def on_tree_built(self):
+    def _on_tree_built(self):
         """Searches the tree for the linked object
+        (using :attr:`~Path.path_index`)
+        """
+        self.linked_obj = self.path_index.get(self.linked_relative_path)
+        super(Link, self)._on_tree_built()
+    @property
+    def linked_relative_path(self):
+        """The :attr:`linked_path` relative to the root of the tree
         """
         p = self.linked_path
-        obj = self.parent
-        while p.startswith(os.path.pardir):
-            obj = obj.parent
-            p = p.lstrip(os.path.pardir).lstrip(os.sep)
-        self.linked_obj = obj.search(p)
-        super(Link, self).on_tree_built()
-    def _write(self, overwrite=False):
+        if os.path.isabs(p):
+            p = os.path.relpath(p, self.root.path)
+        else:
+            p = os.path.join(os.path.dirname(self.relative_path), p)
+        return os.path.normpath(p)
+    def _write(self, overwrite=False, writer=fsio):
         p = self.path
         if os.path.exists(p) and overwrite is False:
-            return
-        l = os.path.join(self.root.path, self.linked_obj.relative_path)
-        l = os.path.relpath(l, os.path.dirname(p))
-        if not os.path.exists(l):
-            if not os.path.exists(os.path.dirname(l)):
-                os.makedirs(os.path.dirname(l))
-            os.mknod(l)
-        os.symlink(l, p)
+            return False
+        # Use linked_path rather than linked_obj so changes to it are written
+        target = os.path.join(self.root.path, self.linked_relative_path)
+        l = os.path.relpath(target, os.path.dirname(p))
+        if not os.path.exists(target):
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            os.mknod(target)
+        # Replaced atomically so the link is never missing
+        writer.symlink(l, p)
+    def _get_write_depends(self):
+        # The linked file must exist before the link is written
+        depends = super(Link, self)._get_write_depends()
+        depends.append(self.linked_relative_path)
+        return depends
+    def quick_equal(self, other, attrs=None):
+        # The metadata is from the linked file, so the links must match too
+        r = super(Link, self).quick_equal(other, attrs)
+        if not r:
+            return r
+        return self.linked_path == other.linked_path
+    def _diff_attrs(self, other):
+        attrs = super(Link, self)._diff_attrs(other)
+        if self.linked_path != other.linked_path:
+            attrs.append('linked_path')
+        return attrs
     def _get_diff(self, other, other_name):
         d = super(Link, self)._get_diff(other, other_name)
         if other is None:
@@ -0,0 +1,212 @@
+"""Compact binary snapshots of :class:`~letssync.structures.base.Path` trees
+
+File contents are split into chunks (each PEM block is its own chunk) and
+every distinct chunk is stored only once, keyed by its hash. This avoids
+storing the certificates contained in "fullchain" files again, along with
+chain files shared between domains.
+
+Layout (all integers big-endian)::
+
+    magic (8 bytes) | version (1 byte) | flags (1 byte) | body
+
+If :data:`FLAG_COMPRESSED` is set, the body is compressed with :mod:`zlib`.
+The body contains::
+
+    class names:  count (u32), then for each: length (u32) | utf-8 bytes
+    blobs:        count (u32), then for each: sha256 digest (32 bytes) |
+                  length (u32) | utf-8 bytes
+    nodes:        count (u32), then for each (parents before children):
+                  parent index (u32, NO_PARENT for the root) |
+                  class index (u32) | length (u32) | compact JSON attributes
+
+File contents in the node attributes are replaced by a list of blob indices
+stored under ``"$content"``.
+"""
+import re
+import json
+import zlib
+import struct
+import hashlib
+
+from letssync.structures.base import Path, to_bytes
+
+MAGIC = b'LSYNCBIN'
+VERSION = 1
+FLAG_COMPRESSED = 0x01
+NO_PARENT = 0xFFFFFFFF
+
+PEM_RE = re.compile(r'-----BEGIN [^-]+-----.*?-----END [^-]+-----\n?', re.DOTALL)
+
+_u32 = struct.Struct('>I')
+_header = struct.Struct('>8sBB')
+
+
+def split_chunks(content):
+    """Splits content into chunks for deduplication
+
+    Each PEM block (with its trailing newline) is a chunk, as is any text
+    between them.
+
+    Returns:
+        list: The chunks, which will join to form the original content
+    """
+    chunks = []
+    pos = 0
+    for m in PEM_RE.finditer(content):
+        if m.start() > pos:
+            chunks.append(content[pos:m.start()])
+        chunks.append(m.group(0))
+        pos = m.end()
+    if pos < len(content) or not len(chunks):
+        chunks.append(content[pos:])
+    return chunks
+
+
+class BlobStore(object):
+    """Holds distinct content chunks keyed by their sha256 digest
+    """
+    def __init__(self):
+        self.blobs = []
+        self.index = {}
+    def add(self, s):
+        b = to_bytes(s)
+        digest = hashlib.sha256(b).digest()
+        i = self.index.get(digest)
+        if i is None:
+            i = self.index[digest] = len(self.blobs)
+            self.blobs.append((digest, b))
+        return i
+
+
+def _write_bytes(parts, b):
+    parts.append(_u32.pack(len(b)))
+    parts.append(b)
+
+def dumps(tree, compress=True):
+    """Serializes the given tree into the binary snapshot format
+
+    Arguments:
+        tree: Any node of the tree (the entire tree is serialized from
+            its root)
+        compress (bool): Whether to compress the body. default is :const:`True`
+
+    Returns:
+        bytes
+    """
+    blobs = BlobStore()
+    classes = []
+    class_index = {}
+    node_parts = []
+    stack = [(tree.root, NO_PARENT)]
+    count = 0
+    while stack:
+        node, parent_index = stack.pop()
+        attrs = node._serialize()
+        cls_name = attrs.pop('class_name')
+        ci = class_index.get(cls_name)
+        if ci is None:
+            ci = class_index[cls_name] = len(classes)
+            classes.append(cls_name)
+        content = attrs.pop('content', None)
+        if content is not None:
+            attrs['$content'] = [blobs.add(c) for c in split_chunks(content)]
+        node_parts.append(_u32.pack(parent_index))
+        node_parts.append(_u32.pack(ci))
+        _write_bytes(node_parts, to_bytes(json.dumps(attrs, separators=(',', ':'))))
+        i = count
+        count += 1
+        for key in reversed(list(node.children.keys())):
+            stack.append((node.children[key], i))
+    parts = [_u32.pack(len(classes))]
+    for cls_name in classes:
+        _write_bytes(parts, to_bytes(cls_name))
+    parts.append(_u32.pack(len(blobs.blobs)))
+    for digest, b in blobs.blobs:
+        parts.append(digest)
+        _write_bytes(parts, b)
+    parts.append(_u32.pack(count))
+    parts.extend(node_parts)
+    body = b''.join(parts)
+    flags = 0
+    if compress:
+        body = zlib.compress(body)
+        flags |= FLAG_COMPRESSED
+    return _header.pack(MAGIC, VERSION, flags) + body
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+    def read(self, n):
+        b = self.data[self.pos:self.pos+n]
+        if len(b) != n:
+            raise ValueError('Unexpected end of snapshot data')
+        self.pos += n
+        return b
+    def read_u32(self):
+        return _u32.unpack(self.read(4))[0]
+    def read_bytes(self):
+        return self.read(self.read_u32())
+    def read_str(self):
+        return self.read_bytes().decode('utf-8')
+
+def loads(data):
+    """Builds a tree from data in the binary snapshot format
+
+    Returns:
+        The root :class:`~letssync.structures.base.Path`
+    """
+    if len(data) < _header.size:
+        raise ValueError('Not a binary snapshot')
+    magic, version, flags = _header.unpack(data[:_header.size])
+    if magic != MAGIC:
+        raise ValueError('Not a binary snapshot')
+    if version != VERSION:
+        raise ValueError('Unsupported snapshot version: {0}'.format(version))
+    body = data[_header.size:]
+    if flags & FLAG_COMPRESSED:
+        body = zlib.decompress(body)
+    r = _Reader(body)
+    classes = [Path.find_subclass(r.read_str()) for i in range(r.read_u32())]
+    blobs = []
+    for i in range(r.read_u32()):
+        digest = r.read(32)
+        b = r.read_bytes()
+        if hashlib.sha256(b).digest() != digest:
+            raise ValueError('Blob {0} does not match its digest'.format(i))
+        blobs.append(b.decode('utf-8'))
+    nodes = []
+    for i in range(r.read_u32()):
+        parent_index = r.read_u32()
+        cls = classes[r.read_u32()]
+        attrs = json.loads(r.read_str())
+        chunks = attrs.pop('$content', None)
+        if chunks is not None:
+            if len(chunks) == 1:
+                attrs['content'] = blobs[chunks[0]]
+            else:
+                attrs['content'] = ''.join(blobs[c] for c in chunks)
+        if parent_index == NO_PARENT:
+            attrs['is_serialized'] = True
+            attrs['defer_tree_built'] = True
+            node = cls(**attrs)
+        else:
+            node = nodes[parent_index].add_child(cls, **attrs)
+        nodes.append(node)
+    if not len(nodes):
+        raise ValueError('Snapshot contains no nodes')
+    root = nodes[0]
+    root.finish_build()
+    return root
+
+def dump(tree, fp, compress=True):
+    """Writes the binary snapshot of a tree to a file object (opened in binary mode)
+    """
+    fp.write(dumps(tree, compress))
+
+def load(fp):
+    """Builds a tree from a file object (opened in binary mode)
+    containing a binary snapshot
+    """
+    return loads(fp.read())
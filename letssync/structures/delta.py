@@ -0,0 +1,148 @@
+"""Delta snapshots containing only the changes made to a tree
+
+A delta is a :class:`dict` (which can be serialized as JSON) containing:
+
+``base_hash``
+    The :attr:`~letssync.structures.base.Path.tree_hash` of the base tree
+``tree_hash``
+    The :attr:`~letssync.structures.base.Path.tree_hash` of the changed tree
+``added``
+    A :class:`list` of serialized attributes for each added node (including
+    its ``relative_path``), with parents listed before their children
+``removed``
+    A :class:`list` of relative paths of removed nodes. The descendants of
+    a removed node are not listed
+``modified``
+    A :class:`dict` of relative paths for each modified node with a
+    :class:`dict` of its changed attributes as values
+"""
+import os
+
+from letssync.structures.base import Path
+
+IGNORED_ATTRS = ['path', 'name']
+
+
+def get_node_attrs(node):
+    """Retrieves the serialized attributes of a node stored in a delta
+    (those in :data:`IGNORED_ATTRS` are left out)
+    """
+    attrs = node._serialize()
+    for key in IGNORED_ATTRS:
+        attrs.pop(key, None)
+    return attrs
+
+def get_delta(tree, base):
+    """Finds the changes made to a tree since the base snapshot
+
+    Arguments:
+        tree: The current tree
+        base: The earlier tree, or any snapshot source accepted by
+            :meth:`letssync.structures.snapshot.Snapshot.load`
+
+    Returns:
+        dict: The delta
+    """
+    if not isinstance(base, Path):
+        from letssync.structures.snapshot import Snapshot
+        base = Snapshot.load(base).nodes['']
+    tree = tree.root
+    base = base.root
+    d = dict(
+        base_hash=base.tree_hash,
+        tree_hash=tree.tree_hash,
+        added=[],
+        removed=[],
+        modified={},
+    )
+    _compare(tree, base, d)
+    return d
+
+def add_subtree(node, d):
+    """Adds a node and all of its descendants to the ``added`` list of a delta
+    """
+    attrs = get_node_attrs(node)
+    attrs['relative_path'] = node.relative_path
+    d['added'].append(attrs)
+    for child in node.children.values():
+        add_subtree(child, d)
+
+def get_changed_attrs(node, base_node):
+    """Finds the attributes of a node that differ from those of the base node
+
+    Returns:
+        dict: The changed attributes with their values from ``node``
+    """
+    attrs = get_node_attrs(node)
+    base_attrs = get_node_attrs(base_node)
+    changed = {}
+    for key, val in attrs.items():
+        if key not in base_attrs or base_attrs[key] != val:
+            changed[key] = val
+    return changed
+
+def _compare(node, base_node, d):
+    if node.__class__ is not base_node.__class__:
+        d['removed'].append(base_node.relative_path)
+        add_subtree(node, d)
+        return
+    changed = get_changed_attrs(node, base_node)
+    if len(changed):
+        d['modified'][node.relative_path] = changed
+    for key, child in node.children.items():
+        base_child = base_node.children.get(key)
+        if base_child is None:
+            add_subtree(child, d)
+        else:
+            _compare(child, base_child, d)
+    for key, base_child in base_node.children.items():
+        if key not in node.children:
+            d['removed'].append(base_child.relative_path)
+
+def apply_delta(tree, d, verify=True):
+    """Applies a delta to a deserialized tree (such as one built by
+    :meth:`~letssync.structures.base.Path.from_json`)
+
+    Arguments:
+        tree: The tree to modify. This should be equal to the base tree
+            used to create the delta
+        d (dict): The delta from :func:`get_delta`
+        verify (bool): If :const:`True` (the default), the tree hashes before
+            and after are checked against those stored in the delta
+
+    Raises:
+        ValueError: If the tree was not deserialized, or if ``verify`` is
+            set and the tree hashes do not match
+
+    Returns:
+        The root of the tree
+    """
+    root = tree.root
+    if not root.is_serialized:
+        raise ValueError('Deltas can only be applied to deserialized trees')
+    if verify and root.tree_hash != d['base_hash']:
+        raise ValueError('Tree does not match the base of the delta')
+    for rel_path in d['removed']:
+        node = root.search(rel_path)
+        if node is None:
+            raise ValueError('Node not found: {0}'.format(rel_path))
+        node.parent.remove_child(node.id)
+    for rel_path, attrs in d['modified'].items():
+        node = root.search(rel_path) if rel_path else root
+        if node is None:
+            raise ValueError('Node not found: {0}'.format(rel_path))
+        node.update_attrs(**attrs)
+    for attrs in d['added']:
+        attrs = attrs.copy()
+        rel_path = attrs.pop('relative_path')
+        parent_path = os.path.dirname(rel_path)
+        parent = root.search(parent_path) if parent_path else root
+        if parent is None:
+            raise ValueError('Parent not found: {0}'.format(rel_path))
+        cls = Path.find_subclass(attrs['class_name'])
+        attrs['path'] = os.path.join(parent.path, attrs['id'])
+        parent.add_child(cls, **attrs)
+    root.on_tree_built()
+    if verify and root.tree_hash != d['tree_hash']:
+        raise ValueError('Tree does not match the delta after applying')
+    return root
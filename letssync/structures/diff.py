@@ -0,0 +1,351 @@
+"""Streaming comparison of two trees
+
+:func:`iter_diff` walks both trees together and yields a :class:`Change`
+for each node that differs. A change only holds references to the nodes
+involved, so file contents and text diffs are not produced until they
+are requested (through :meth:`Change.get_diff`, :meth:`Change.get_values`
+or :meth:`Change.unified_diff`).
+
+:meth:`~letssync.structures.base.Path.get_diff` collects these changes
+into a :class:`dict`.
+
+Text diffs are bounded by a size limit (see
+:attr:`~letssync.structures.base.FileObj.max_diff_size`). Contents which
+are too large, or where a text diff is of no use (PEM blocks or binary
+data), are only described by their hash and size (see :func:`summarize`).
+"""
+import difflib
+import hashlib
+
+from letssync.structures.base import Directory, to_bytes, zip_children
+from letssync.structures.binary import PEM_RE
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+TRUNCATED = '... diff truncated ({0} characters shown)'
+
+
+def is_text(content):
+    """Checks whether a text diff of the given content is useful
+
+    Returns:
+        bool: :const:`False` if the content contains PEM blocks or
+        null characters (binary data)
+    """
+    if '\0' in content:
+        return False
+    return PEM_RE.search(content) is None
+
+def summarize(content):
+    """Describes content by its size and hash
+
+    Returns:
+        dict: ``size`` (the length in bytes) and ``sha256`` (hex digest)
+    """
+    b = to_bytes(content)
+    return {'size':len(b), 'sha256':hashlib.sha256(b).hexdigest()}
+
+def can_diff(a, b, max_size):
+    """Checks whether a text diff should be made between two contents
+
+    Arguments:
+        a (str): The first content (:const:`None` if missing)
+        b (str): The second content (:const:`None` if missing)
+        max_size (int): The maximum length of either content. If
+            :const:`None`, the size is not limited
+    """
+    for content in [a, b]:
+        if content is None:
+            continue
+        if max_size is not None and len(content) > max_size:
+            return False
+        if not is_text(content):
+            return False
+    return True
+
+def iter_unified_diff(a, b, fromfile='', tofile='', n=3, max_size=None):
+    """Generates the lines of a unified diff between two contents
+
+    If ``max_size`` is given, no more lines are generated once that many
+    characters have been produced. A final line (:data:`TRUNCATED`) is then
+    added to note this.
+    """
+    lines = difflib.unified_diff(
+        (a or '').splitlines(),
+        (b or '').splitlines(),
+        fromfile,
+        tofile,
+        n=n,
+        lineterm='',
+    )
+    size = 0
+    for line in lines:
+        size += len(line) + 1
+        if max_size is not None and size > max_size:
+            yield TRUNCATED.format(size - len(line) - 1)
+            return
+        yield line
+
+def get_content_diff(a, b, name, other_name, max_size=None):
+    """Builds the ``content`` entry for
+    :meth:`~letssync.structures.base.FileObj._get_diff`
+
+    Returns:
+        dict: If a text diff can be made (see :func:`can_diff`), the contents
+        with ``name`` and ``other_name`` as keys along with the (bounded)
+        text under ``diff``. Otherwise the :func:`summarize` results
+        for each content
+    """
+    if not can_diff(a, b, max_size):
+        return {name:summarize(a), other_name:summarize(b)}
+    d = {name:a, other_name:b}
+    d['diff'] = '\n'.join(iter_unified_diff(a, b, name, other_name, max_size=max_size))
+    return d
+
+
+class Change(object):
+    """A difference found for a single node
+
+    Attributes:
+        node: The node in the first tree (:const:`None` if the node was added)
+        other: The node in the second tree (:const:`None` if the node was
+            removed)
+        name (str): The :attr:`~letssync.structures.base.Path.name` of the
+            first tree
+        other_name (str): The name used for the second tree
+        attrs (list): The names of the attributes that differ. For added or
+            removed nodes, this is every serialized attribute
+    """
+    def __init__(self, node, other, name, other_name, attrs):
+        self.node = node
+        self.other = other
+        self.name = name
+        self.other_name = other_name
+        self.attrs = attrs
+    @property
+    def kind(self):
+        """One of :data:`ADDED`, :data:`REMOVED` or :data:`MODIFIED`
+        """
+        if self.node is None:
+            return ADDED
+        if self.other is None:
+            return REMOVED
+        return MODIFIED
+    @property
+    def relative_path(self):
+        if self.node is None:
+            return self.other.relative_path
+        return self.node.relative_path
+    def get_values(self, attr):
+        """Retrieves the value of an attribute from both nodes
+
+        Returns:
+            tuple: The values from :attr:`node` and :attr:`other`
+            (:const:`None` for a missing node)
+        """
+        values = []
+        for obj in [self.node, self.other]:
+            if obj is None:
+                values.append(None)
+            else:
+                values.append(getattr(obj, attr))
+        return tuple(values)
+    def get_diff(self):
+        """Builds the same :class:`dict` stored for this node by
+        :meth:`~letssync.structures.base.Path.get_diff`
+        (including contents and text diffs)
+        """
+        if self.node is None:
+            return self.other._get_diff(None, self.name)
+        return self.node._get_diff(self.other, self.other_name)
+    def unified_diff(self, n=3, max_size=None):
+        """Generates a unified diff of the file contents
+
+        The diff is produced line by line as it is consumed. Nothing is
+        generated unless ``'content'`` is in :attr:`attrs` and a text diff
+        can be made (see :func:`can_diff`).
+
+        Arguments:
+            n (int): The number of context lines. default is 3
+            max_size (int): The size limit for the contents and the diff.
+                If not given, the
+                :attr:`~letssync.structures.base.FileObj.max_diff_size`
+                of the node is used
+        """
+        if 'content' not in self.attrs:
+            return iter([])
+        if max_size is None:
+            obj = self.node if self.node is not None else self.other
+            max_size = getattr(obj, 'max_diff_size', None)
+        a, b = self.get_values('content')
+        if not can_diff(a, b, max_size):
+            return iter([])
+        return iter_unified_diff(a, b, self.name, self.other_name, n, max_size)
+    def __repr__(self):
+        return '<{0}: {1} {2}>'.format(
+            self.__class__.__name__, self.kind, self.relative_path,
+        )
+
+
+def _get_all_attrs(node):
+    attrs = ['class_name']
+    attrs.extend(node.get_serialize_attrs())
+    if node.parent is None:
+        attrs.append('name')
+    return attrs
+
+def iter_diff(tree, other, other_name=None, quick_check=False):
+    """Compares two trees, yielding a :class:`Change` for each differing node
+
+    Subtrees with equal :attr:`~letssync.structures.base.Path.tree_hash`
+    values are skipped. Parents are yielded before their children.
+
+    Arguments:
+        tree: The node to compare from
+        other: The node to compare against
+        other_name (str): The name to use for the ``other`` tree.
+            If not given, the :attr:`~letssync.structures.base.Path.name`
+            of each tree is used (and set to a unique value if missing)
+        quick_check: If :const:`True` (or a sequence of attribute names),
+            nodes matching
+            :meth:`~letssync.structures.base.Path.quick_equal` are
+            considered unchanged and subtrees are only skipped by their
+            :attr:`~letssync.structures.base.Path.tree_hash` if it has
+            already been computed. This avoids reading file contents
+            for unchanged files
+    """
+    quick_attrs = None if quick_check is True else quick_check
+    if other_name is None:
+        if tree.name is None:
+            tree.root.name = str(id(tree.root))
+        if other.name is None:
+            other.root.name = str(id(other.root))
+        other_name = other.name
+    name = tree.name
+    stack = [(tree, other)]
+    while stack:
+        node, other_node = stack.pop()
+        if node is None:
+            yield Change(None, other_node, name, other_name, _get_all_attrs(other_node))
+            stack.extend(reversed([(None, c) for c in other_node.children.values()]))
+            continue
+        if other_node is None:
+            yield Change(node, None, name, other_name, _get_all_attrs(node))
+            stack.extend(reversed([(c, None) for c in node.children.values()]))
+            continue
+        if quick_check:
+            if node._cached_hash_equal(other_node):
+                continue
+            changed = not node.quick_equal(other_node, quick_attrs) and node != other_node
+        elif node.tree_hash == other_node.tree_hash:
+            continue
+        else:
+            changed = node != other_node
+        if changed:
+            attrs = node._diff_attrs(other_node)
+            if len(attrs):
+                yield Change(node, other_node, name, other_name, attrs)
+        children = []
+        for key, child in node.children.items():
+            children.append((child, other_node.children.get(key)))
+        for key, other_child in other_node.children.items():
+            if key not in node.children:
+                children.append((None, other_child))
+        stack.extend(reversed(children))
+
+
+class MultiChange(object):
+    """The differences found for a single node by :func:`iter_multi_diff`
+
+    Attributes:
+        relative_path (str)
+        nodes (dict): The node from each tree (:const:`None` if missing)
+            with the tree names as keys
+        groups (list): The names of the trees containing the node, grouped
+            by those that agree with each other (largest group first)
+        missing (list): The names of the trees missing the node
+    """
+    def __init__(self, relative_path, nodes, groups, missing):
+        self.relative_path = relative_path
+        self.nodes = nodes
+        self.groups = groups
+        self.missing = missing
+    def serialize(self):
+        return {'groups':self.groups, 'missing':self.missing}
+    def __repr__(self):
+        return '<{0}: {1} {2!r} missing={3!r}>'.format(
+            self.__class__.__name__, self.relative_path, self.groups, self.missing,
+        )
+
+
+def _get_group_key(node):
+    # Directories are compared through their children, so only the class
+    # is used for them (as with Path._diff_attrs)
+    if isinstance(node, Directory):
+        return node.__class__.__name__
+    return node.content_hash
+
+def iter_multi_diff(trees, names=None):
+    """Compares any number of trees in a single walk over all of their paths
+
+    A :class:`MultiChange` is yielded for each node where the trees do not
+    all agree. A node missing from some trees is only reported at the top
+    of the missing subtree, unless the remaining trees differ below it.
+    Subtrees with the same :attr:`~letssync.structures.base.Path.tree_hash`
+    in every tree containing them are skipped.
+
+    Arguments:
+        trees: A sequence of trees (typically the roots of
+            :class:`~letssync.structures.base.Directory` trees)
+        names: The names to use for each tree. If not given, the
+            :attr:`~letssync.structures.base.Path.name` of each tree is used
+            (or its index if it has no name)
+    """
+    if names is None:
+        names = []
+        for i, tree in enumerate(trees):
+            names.append(tree.name if tree.name is not None else str(i))
+    if len(set(names)) != len(names):
+        raise ValueError('Tree names must be unique')
+    stack = [(tuple(trees), tuple(trees))]
+    while stack:
+        nodes, parents = stack.pop()
+        present = [i for i, node in enumerate(nodes) if node is not None]
+        missing = [i for i, node in enumerate(nodes) if node is None]
+        new_missing = [i for i in missing if parents[i] is not None]
+        first = nodes[present[0]]
+        tree_hash = first.tree_hash
+        if all(nodes[i].tree_hash == tree_hash for i in present[1:]):
+            groups = [present]
+            skip = True
+        else:
+            groups = {}
+            for i in present:
+                groups.setdefault(_get_group_key(nodes[i]), []).append(i)
+            groups = sorted(groups.values(), key=lambda g: (-len(g), g[0]))
+            skip = False
+        if len(groups) > 1 or len(new_missing):
+            yield MultiChange(
+                first.relative_path,
+                dict((names[i], nodes[i]) for i in range(len(nodes))),
+                [[names[i] for i in group] for group in groups],
+                [names[i] for i in missing],
+            )
+        if skip:
+            continue
+        children = [(child_nodes, nodes) for child_nodes in zip_children(nodes)]
+        stack.extend(reversed(children))
+
+def get_multi_diff(trees, names=None):
+    """Builds a :class:`dict` of the results of :func:`iter_multi_diff`
+
+    Returns:
+        dict: The relative paths as keys with the ``groups`` and ``missing``
+        tree names for each as values
+    """
+    d = {}
+    for change in iter_multi_diff(trees, names):
+        d[change.relative_path] = change.serialize()
+    return d
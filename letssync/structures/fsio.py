@@ -0,0 +1,506 @@
+import os
+import stat as _stat
+import errno
+import shutil
+import binascii
+import weakref
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+
+try:
+    from os import scandir as _scandir
+except ImportError: # pragma: no cover
+    from scandir import scandir as _scandir
+
+
+class IOCounter(object):
+    """Keeps count of the filesystem operations performed through this module
+
+    Can be used as a context manager to reset the counts before a block::
+
+        with io_counter:
+            tree = build_tree(root_path)
+        print(io_counter['stat'])
+
+    Attributes:
+        counts (dict): Operation names as keys with the number of times they
+            were performed as values
+    """
+    def __init__(self):
+        self.counts = {}
+        self.lock = threading.Lock()
+    def increment(self, op, n=1):
+        with self.lock:
+            self.counts[op] = self.counts.get(op, 0) + n
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+    def __getitem__(self, op):
+        return self.counts.get(op, 0)
+    def __enter__(self):
+        self.reset()
+        return self
+    def __exit__(self, *args):
+        pass
+    def __repr__(self):
+        return '<{0}: {1!r}>'.format(self.__class__.__name__, self.counts)
+
+io_counter = IOCounter()
+
+
+class ContentCache(object):
+    """A bounded (least recently used) cache for lazily loaded node data
+
+    Values are stored per object and attribute name. Only a weak reference
+    to the object is kept, so cached values never keep a node alive.
+    Access is locked, so the cache can be shared by threads (such as those
+    of a :class:`WriteExecutor`).
+
+    Attributes:
+        maxsize (int): The maximum number of values to hold. When exceeded,
+            the least recently used values are dropped
+    """
+    def __init__(self, maxsize=256):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.maxsize = maxsize
+    @property
+    def maxsize(self):
+        return self._maxsize
+    @maxsize.setter
+    def maxsize(self, value):
+        with self._lock:
+            self._maxsize = value
+            self._trim()
+    def _trim(self):
+        # Called with the lock held
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+    def get(self, obj, attr):
+        """Retrieves a cached value
+
+        Returns:
+            The value if found, otherwise :const:`None`
+        """
+        key = (id(obj), attr)
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None:
+                return None
+            ref, value = item
+            if ref() is not obj:
+                return None
+            self._data[key] = item
+        return value
+    def set(self, obj, attr, value):
+        key = (id(obj), attr)
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (weakref.ref(obj), value)
+            self._trim()
+    def discard(self, obj, attr):
+        with self._lock:
+            self._data.pop((id(obj), attr), None)
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+    def __len__(self):
+        return len(self._data)
+
+content_cache = ContentCache()
+
+def scandir(path):
+    """Lists the contents of a directory using :func:`os.scandir`
+
+    Returns:
+        list: The :class:`os.DirEntry` objects sorted by name
+    """
+    io_counter.increment('scandir')
+    return sorted(_scandir(path), key=lambda e: e.name)
+
+def stat(path):
+    io_counter.increment('stat')
+    return os.stat(path)
+
+def entry_stat(entry):
+    """Retrieves the stat result from a :class:`os.DirEntry`
+
+    Symlinks are followed (matching :func:`os.stat`). The result is cached
+    by the entry, so this should only be called once per entry.
+    """
+    io_counter.increment('stat')
+    return entry.stat()
+
+def readlink(path):
+    io_counter.increment('readlink')
+    return os.readlink(path)
+
+def read_file(path):
+    io_counter.increment('read')
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def to_bytes(s):
+    """Encodes text as UTF-8 (:class:`bytes` are returned unchanged)
+    """
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+def fsync_dir(path):
+    """Flushes a directory's entries (such as a rename into it) to disk
+    """
+    io_counter.increment('fsync')
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _get_temp_path(path):
+    dirname, fn = os.path.split(path)
+    suffix = binascii.hexlify(os.urandom(4)).decode('ascii')
+    return os.path.join(dirname, '.{0}.{1}.tmp'.format(fn, suffix))
+
+
+class BatchWriter(object):
+    """Writes files and links atomically, grouping directory fsyncs
+
+    Files are written to a temporary file in the same directory (created
+    with the final mode), flushed to disk and renamed into place, so a
+    crash never leaves a partially written file. Links are replaced the same
+    way. The directories containing the renamed entries are only synced
+    once per batch by :meth:`flush` (called when used as a context
+    manager)::
+
+        with BatchWriter() as writer:
+            writer.write_file(path, content, mode)
+
+    The module-level functions (:func:`write_file`, :func:`symlink`,
+    :func:`makedirs`, :func:`remove` and :func:`chmod`) perform a single
+    operation and sync right away. The module can be used in place of an
+    instance where no batching is needed.
+
+    Attributes:
+        fsync (bool): If :const:`False`, nothing is synced to disk (the
+            writes are still atomic). default is :const:`True`
+        pending_dirs (set): The directories to sync on :meth:`flush`
+    """
+    def __init__(self, fsync=True):
+        self.fsync = fsync
+        self.pending_dirs = set()
+        self.lock = threading.Lock()
+    def _add_dir(self, path):
+        if not self.fsync:
+            return
+        with self.lock:
+            self.pending_dirs.add(path)
+    def write_file(self, path, content, mode=None):
+        """Atomically replaces the file at ``path``
+
+        Arguments:
+            path (str): The destination path
+            content: The file content (:class:`str` or :class:`bytes`)
+            mode (int): The mode of the new file. If not given, the default
+                mode for new files is used
+        """
+        io_counter.increment('write')
+        tmp = _get_temp_path(path)
+        perm = 0o666 if mode is None else _stat.S_IMODE(mode)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, perm)
+        try:
+            if mode is not None:
+                # Not limited by the umask
+                os.fchmod(fd, perm)
+            with os.fdopen(fd, 'wb') as f:
+                fd = None
+                f.write(to_bytes(content))
+                f.flush()
+                if self.fsync:
+                    io_counter.increment('fsync')
+                    os.fsync(f.fileno())
+            os.rename(tmp, path)
+        except Exception:
+            if fd is not None:
+                os.close(fd)
+            if os.path.lexists(tmp):
+                os.remove(tmp)
+            raise
+        self._add_dir(os.path.dirname(path))
+    def symlink(self, target, path):
+        """Atomically creates or replaces a symlink at ``path``
+        """
+        io_counter.increment('symlink')
+        while True:
+            tmp = _get_temp_path(path)
+            try:
+                os.symlink(target, tmp)
+            except OSError as e:
+                if e.errno == errno.EEXIST:
+                    continue
+                raise
+            break
+        try:
+            os.rename(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+        self._add_dir(os.path.dirname(path))
+    def makedirs(self, path, mode=None):
+        """Creates a directory (and any missing parents)
+
+        The mode is only set on ``path`` itself.
+        """
+        io_counter.increment('mkdir')
+        missing = []
+        p = path
+        while p and not os.path.exists(p):
+            missing.append(p)
+            p = os.path.dirname(p)
+        if len(missing):
+            os.makedirs(path)
+        if mode is not None:
+            os.chmod(path, _stat.S_IMODE(mode))
+        for p in missing:
+            self._add_dir(os.path.dirname(p))
+    def remove(self, path):
+        """Removes a file, link or directory tree
+        """
+        io_counter.increment('remove')
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        elif os.path.lexists(path):
+            os.remove(path)
+        else:
+            return
+        self._add_dir(os.path.dirname(path))
+    def chmod(self, path, mode):
+        io_counter.increment('chmod')
+        os.chmod(path, _stat.S_IMODE(mode))
+    def flush(self):
+        """Syncs the directories changed since the last flush
+        """
+        with self.lock:
+            dirs = sorted(self.pending_dirs)
+            self.pending_dirs.clear()
+        for path in dirs:
+            fsync_dir(path)
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        self.flush()
+
+def write_file(path, content, mode=None):
+    """Atomically replaces a file and syncs it (see :class:`BatchWriter`)
+    """
+    with BatchWriter() as writer:
+        writer.write_file(path, content, mode)
+
+def symlink(target, path):
+    with BatchWriter() as writer:
+        writer.symlink(target, path)
+
+def makedirs(path, mode=None):
+    with BatchWriter() as writer:
+        writer.makedirs(path, mode)
+
+def remove(path):
+    with BatchWriter() as writer:
+        writer.remove(path)
+
+def chmod(path, mode):
+    io_counter.increment('chmod')
+    os.chmod(path, _stat.S_IMODE(mode))
+
+
+class ParallelScanner(object):
+    """Scans a directory tree and reads its files using a pool of threads
+
+    The results are held until they are requested through the methods
+    matching the module-level functions (:func:`scandir`, :func:`entry_stat`,
+    :func:`stat`, :func:`readlink` and :func:`read_file`), so an instance can
+    be used in place of this module while a tree is being built.
+    Anything not found in the results is read directly.
+
+    Arguments:
+        root_path (str): The directory to scan
+        workers (int): The number of threads to use
+        read_files (bool): If :const:`False`, only scan the directories and
+            links. default is :const:`True`
+        snapshot: An optional :class:`~letssync.structures.snapshot.Snapshot`.
+            Files that are unchanged according to it are not read
+    """
+    def __init__(self, root_path, workers=8, read_files=True, snapshot=None):
+        self.root_path = root_path
+        self.workers = workers
+        self.read_files = read_files
+        self.snapshot = snapshot
+        self.entries = {}
+        self.links = {}
+        self.contents = {}
+    def run(self):
+        """Performs the scan and waits for all reads to complete
+        """
+        self._root_stat = stat(self.root_path)
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            self._pool = pool
+            self._futures = []
+            self._lock = threading.Lock()
+            self._submit(self._scan_dir, self.root_path)
+            i = 0
+            while True:
+                with self._lock:
+                    if i >= len(self._futures):
+                        break
+                    fut = self._futures[i]
+                fut.result()
+                i += 1
+        self._pool = None
+        return self
+    def _submit(self, fn, *args):
+        fut = self._pool.submit(fn, *args)
+        with self._lock:
+            self._futures.append(fut)
+    def _scan_dir(self, path):
+        entries = scandir(path)
+        for entry in entries:
+            if entry.is_dir():
+                entry_stat(entry)
+                self._submit(self._scan_dir, entry.path)
+            elif entry.is_symlink():
+                entry_stat(entry)
+                self.links[entry.path] = readlink(entry.path)
+            elif entry.is_file():
+                self._submit(self._read_file, entry)
+        self.entries[path] = entries
+    def _read_file(self, entry):
+        st = entry_stat(entry)
+        if not self.read_files:
+            return
+        if self.snapshot is not None:
+            rel_path = os.path.relpath(entry.path, self.root_path)
+            if self.snapshot.get_node(rel_path, st) is not None:
+                return
+        self.contents[entry.path] = read_file(entry.path)
+    def scandir(self, path):
+        entries = self.entries.pop(path, None)
+        if entries is None:
+            return scandir(path)
+        return entries
+    def entry_stat(self, entry):
+        # Already called (and cached by the entry) during the scan
+        return entry.stat()
+    def stat(self, path):
+        if path == self.root_path:
+            return self._root_stat
+        return stat(path)
+    def readlink(self, path):
+        if path in self.links:
+            return self.links.pop(path)
+        return readlink(path)
+    def read_file(self, path):
+        if path in self.contents:
+            return self.contents.pop(path)
+        return read_file(path)
+
+
+class WriteExecutor(object):
+    """Runs writes on a pool of threads while respecting their dependencies
+
+    Each task is added with the keys of the tasks it depends on (such as
+    the directory a file is written to) and is only started once those
+    have completed. Dependencies on keys that were never added are ignored,
+    since those paths are assumed to exist already.
+
+    Arguments:
+        workers (int): The number of threads to use
+    """
+    def __init__(self, workers=8):
+        self.workers = workers
+        self.tasks = OrderedDict()
+    def add(self, key, fn, args=(), depends=()):
+        """Adds a task
+
+        Arguments:
+            key: A unique key for the task (such as its path)
+            fn: The callable to run
+            args: Arguments for ``fn``
+            depends: The keys of the tasks that must complete first
+        """
+        self.tasks[key] = (fn, args, depends)
+    def run(self):
+        """Runs all tasks and waits for them to complete
+
+        If a task raises an exception, any tasks waiting to start are
+        cancelled and no further tasks are submitted. The exception is
+        raised once the tasks already running have finished.
+
+        Returns:
+            dict: The return values of each task with their keys
+        """
+        self._waiting = {}
+        self._dependents = {}
+        for key, (fn, args, depends) in self.tasks.items():
+            deps = set(d for d in depends if d in self.tasks and d != key)
+            self._waiting[key] = len(deps)
+            for dep in deps:
+                self._dependents.setdefault(dep, []).append(key)
+        self.results = {}
+        self._failed = False
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            self._pool = pool
+            self._futures = []
+            self._lock = threading.Lock()
+            for key, n in list(self._waiting.items()):
+                if n == 0:
+                    self._submit(key)
+            i = 0
+            try:
+                while True:
+                    with self._lock:
+                        if i >= len(self._futures):
+                            break
+                        fut = self._futures[i]
+                    i += 1
+                    try:
+                        fut.result()
+                    except CancelledError:
+                        # Cancelled by a failed task, whose error is raised
+                        continue
+            except Exception:
+                with self._lock:
+                    self._cancel()
+                raise
+        self._pool = None
+        if len(self.results) < len(self.tasks):
+            raise ValueError('Circular dependencies between tasks')
+        return self.results
+    def _submit(self, key):
+        with self._lock:
+            if self._failed:
+                return
+            self._futures.append(self._pool.submit(self._run_task, key))
+    def _cancel(self):
+        # Called with the lock held
+        self._failed = True
+        for fut in self._futures:
+            fut.cancel()
+    def _run_task(self, key):
+        fn, args, depends = self.tasks[key]
+        try:
+            result = fn(*args)
+        except Exception:
+            with self._lock:
+                self._cancel()
+            raise
+        ready = []
+        with self._lock:
+            self.results[key] = result
+            for dependent in self._dependents.get(key, []):
+                self._waiting[dependent] -= 1
+                if self._waiting[dependent] == 0:
+                    ready.append(dependent)
+        for dependent in ready:
+            self._submit(dependent)
@@ -0,0 +1,183 @@
+"""Streaming JSON serialization for :class:`~letssync.structures.base.Path` trees
+
+The format is the same as :meth:`~letssync.structures.base.Path.to_json`,
+with the requirement that the "children" member is the last member of each
+node object (which is always the case for the output of
+:meth:`~letssync.structures.base.Path.to_json` and :func:`dump`).
+"""
+import json
+
+from letssync.structures.base import Path
+
+CHUNK_SIZE = 65536
+NUMBER_CHARS = '0123456789.eE+-'
+
+
+def dump(tree, fp, indent=None):
+    """Writes the given tree to a file object node by node
+
+    Arguments:
+        tree: The root :class:`~letssync.structures.base.Path` to write
+        fp: A file object opened in text mode
+        indent (int): If given, the output is indented by this amount.
+            Otherwise a compact form is written
+    """
+    if indent is None:
+        _dump_node(tree, fp, None, '', ',', ':')
+    else:
+        _dump_node(tree, fp, indent, '', ',', ': ')
+    if indent is not None:
+        fp.write('\n')
+
+def _dump_node(node, fp, indent, prefix, item_sep, key_sep):
+    if indent is None:
+        inner = ''
+        nl = ''
+    else:
+        inner = prefix + ' ' * indent
+        nl = '\n'
+    def dumps(value):
+        s = json.dumps(value, indent=indent, separators=(item_sep, key_sep))
+        if indent is not None:
+            s = s.replace('\n', '\n' + inner)
+        return s
+    fp.write('{')
+    for key, val in node._serialize().items():
+        fp.write(''.join([nl, inner, dumps(key), key_sep, dumps(val), item_sep]))
+    fp.write(''.join([nl, inner, dumps('children'), key_sep, '{']))
+    child_prefix = inner + ' ' * indent if indent is not None else ''
+    for i, key in enumerate(node.children.keys()):
+        if i > 0:
+            fp.write(item_sep)
+        fp.write(''.join([nl, child_prefix, dumps(key), key_sep]))
+        _dump_node(node.children[key], fp, indent, child_prefix, item_sep, key_sep)
+    if len(node.children):
+        fp.write(nl + inner)
+    fp.write('}' + nl + prefix + '}')
+
+
+class JSONReader(object):
+    """Reads JSON tokens incrementally from a file object
+    """
+    def __init__(self, fp, chunk_size=None):
+        if chunk_size is None:
+            chunk_size = CHUNK_SIZE
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+    def fill(self):
+        if self.eof:
+            return False
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+    def peek(self):
+        """Skips whitespace and returns the next character (without consuming)
+        """
+        while True:
+            buf = self.buf
+            n = len(buf)
+            pos = self.pos
+            while pos < n and buf[pos] in ' \t\n\r':
+                pos += 1
+            self.pos = pos
+            if pos < n:
+                return buf[pos]
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON data')
+    def expect(self, chars):
+        c = self.peek()
+        if c not in chars:
+            raise ValueError('Expected one of {0!r} at position {1}, found {2!r}'.format(
+                chars, self.pos, c,
+            ))
+        self.pos += 1
+        return c
+    def read_value(self):
+        """Reads a complete JSON value
+        """
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self.fill():
+                    raise
+                continue
+            if self._may_continue(val, end) and self.fill():
+                continue
+            self.pos = end
+            return val
+
+
+    def _may_continue(self, val, end):
+        # A number split between chunks (such as "12." or "1e")
+        # can decode successfully without being complete
+        if end >= len(self.buf):
+            return True
+        if isinstance(val, bool) or not isinstance(val, (int, float)):
+            return False
+        return self.buf[end] in NUMBER_CHARS
+
+
+def load(fp):
+    """Builds a tree from a file object containing JSON
+
+    Each node is created (and added to its parent) as soon as its attributes
+    have been read, before its children are parsed.
+
+    Returns:
+        The root :class:`~letssync.structures.base.Path`
+    """
+    reader = JSONReader(fp)
+    root = _load_node(reader, None)
+    root.finish_build()
+    return root
+
+def _build_node(parent, attrs):
+    cls = Path.find_subclass(attrs['class_name'])
+    if parent is None:
+        attrs['is_serialized'] = True
+        attrs['defer_tree_built'] = True
+        return cls(**attrs)
+    return parent.add_child(cls, **attrs)
+
+def _load_node(reader, parent):
+    reader.expect('{')
+    attrs = {}
+    node = None
+    if reader.peek() == '}':
+        raise ValueError('Empty node object')
+    while True:
+        key = reader.read_value()
+        reader.expect(':')
+        if key == 'children':
+            node = _build_node(parent, attrs)
+            reader.expect('{')
+            if reader.peek() == '}':
+                reader.pos += 1
+            else:
+                while True:
+                    reader.read_value()
+                    reader.expect(':')
+                    _load_node(reader, node)
+                    if reader.expect(',}') == '}':
+                        break
+        elif node is not None:
+            raise ValueError('"children" must be the last member of a node')
+        else:
+            attrs[key] = reader.read_value()
+        if reader.expect(',}') == '}':
+            break
+    if node is None:
+        node = _build_node(parent, attrs)
+    return node
@@ -0,0 +1,76 @@
+import json
+
+
+class Manifest(object):
+    """A compact summary of a tree's hashes used to check if two hosts are in
+    sync before exchanging any tree data
+
+    Attributes:
+        name (str): The :attr:`~letssync.structures.base.Path.name` of the tree
+        root_hash (str): The :attr:`~letssync.structures.base.Path.tree_hash`
+            of the root
+        subtrees (dict): The ``tree_hash`` of each top-level subtree listed in
+            :attr:`subtree_names`. Missing subtrees have a value of :const:`None`
+        subtree_names: (Class attribute) The top-level directories included
+    """
+    subtree_names = ['accounts', 'archive', 'live', 'renewal']
+    def __init__(self, **kwargs):
+        self.name = kwargs.get('name')
+        self.root_hash = kwargs.get('root_hash')
+        self.subtrees = kwargs.get('subtrees', {})
+    @classmethod
+    def from_tree(cls, tree):
+        """Builds a :class:`Manifest` from the root of the given tree
+        """
+        root = tree.root
+        subtrees = {}
+        for key in cls.subtree_names:
+            child = root.children.get(key)
+            if child is None:
+                subtrees[key] = None
+            else:
+                subtrees[key] = child.tree_hash
+        return cls(name=root.name, root_hash=root.tree_hash, subtrees=subtrees)
+    @classmethod
+    def from_json(cls, s):
+        return cls(**json.loads(s))
+    def serialize(self):
+        return dict(
+            name=self.name,
+            root_hash=self.root_hash,
+            subtrees=self.subtrees.copy(),
+        )
+    def to_json(self):
+        """Serializes the manifest into a compact JSON string
+        """
+        return json.dumps(self.serialize(), separators=(',', ':'), sort_keys=True)
+    def get_changed(self, other):
+        """Finds the subtrees that differ from another :class:`Manifest`
+
+        Returns:
+            list: The names of subtrees that need a full
+            :meth:`~letssync.structures.base.Path.get_diff`. This will be
+            empty if the trees are in sync. If the root hashes differ but
+            none of the subtrees do, the root's relative path (``''``) is
+            returned
+        """
+        if self.root_hash == other.root_hash:
+            return []
+        keys = set(self.subtrees.keys()) | set(other.subtrees.keys())
+        changed = []
+        for key in sorted(keys):
+            if self.subtrees.get(key) != other.subtrees.get(key):
+                changed.append(key)
+        if not len(changed):
+            changed.append('')
+        return changed
+    def __eq__(self, other):
+        if not isinstance(other, Manifest):
+            return False
+        return self.root_hash == other.root_hash
+    def __ne__(self, other):
+        return not self == other
+    def __repr__(self):
+        return '<{0}: {1} ({2})>'.format(
+            self.__class__.__name__, self.name, self.root_hash,
+        )
@@ -0,0 +1,214 @@
+"""Three-way merging of trees
+
+:func:`merge` compares two trees (such as the same configuration on two
+hosts) against a common ancestor, usually a snapshot saved with
+:meth:`~letssync.structures.base.Path.to_json` at the last sync. A change
+made on only one side is resolved automatically. Changes made on both
+sides are only reported as a :class:`Conflict` if they differ.
+
+Nodes are compared using their
+:attr:`~letssync.structures.base.Path.content_hash` and file mode, so a
+change to the permissions alone is merged as well. If modes are not checked,
+subtrees are skipped using their
+:attr:`~letssync.structures.base.Path.tree_hash`, so only changed nodes are
+visited.
+"""
+from letssync.structures import delta
+from letssync.structures.base import (
+    Path, WALK_SKIP, WALK_STOP, walk_tree, zip_children,
+)
+from letssync.structures.diff import ADDED, REMOVED, MODIFIED
+
+SIDES = ('a', 'b')
+
+BOTH_MODIFIED = 'both_modified'
+BOTH_ADDED = 'both_added'
+REMOVED_MODIFIED = 'removed_modified'
+
+
+class MergeChange(object):
+    """A change made on one side which can be applied to the other
+
+    Added and removed nodes are recorded once for the top of the subtree.
+
+    Attributes:
+        relative_path (str)
+        kind (str): One of :data:`~letssync.structures.diff.ADDED`,
+            :data:`~letssync.structures.diff.REMOVED` or
+            :data:`~letssync.structures.diff.MODIFIED`
+        side (str): The side the change was made on (``'a'`` or ``'b'``)
+        node: The changed node (:const:`None` if removed)
+        base: The node in the base tree (:const:`None` if added)
+    """
+    def __init__(self, relative_path, kind, side, node, base):
+        self.relative_path = relative_path
+        self.kind = kind
+        self.side = side
+        self.node = node
+        self.base = base
+    def __repr__(self):
+        return '<{0}: {1} {2} ({3})>'.format(
+            self.__class__.__name__, self.kind, self.relative_path, self.side,
+        )
+
+
+class Conflict(object):
+    """Differing changes made to the same node on both sides
+
+    Attributes:
+        relative_path (str)
+        reason (str): One of :data:`BOTH_MODIFIED`, :data:`BOTH_ADDED` or
+            :data:`REMOVED_MODIFIED`
+        base: The node in the base tree (:const:`None` if added on both sides)
+        a: The node from side ``'a'`` (:const:`None` if removed)
+        b: The node from side ``'b'`` (:const:`None` if removed)
+    """
+    def __init__(self, relative_path, reason, base, a, b):
+        self.relative_path = relative_path
+        self.reason = reason
+        self.base = base
+        self.a = a
+        self.b = b
+    def __repr__(self):
+        return '<{0}: {1} {2}>'.format(
+            self.__class__.__name__, self.reason, self.relative_path,
+        )
+
+
+class MergePlan(object):
+    """The result of :func:`merge`
+
+    Attributes:
+        base: The root of the base tree
+        trees (dict): The roots of the merged trees with the sides
+            (``'a'`` and ``'b'``) as keys
+        changes (list): The :class:`MergeChange` objects which can be
+            applied automatically (parents before children)
+        conflicts (list): The :class:`Conflict` objects. Nodes below a
+            conflict are not compared
+    """
+    def __init__(self, base, a, b):
+        self.base = base
+        self.trees = {'a':a, 'b':b}
+        self.changes = []
+        self.conflicts = []
+    def get_changes(self, side):
+        """Retrieves the changes needed to bring one side up to date
+        (those made on the other side)
+        """
+        return [c for c in self.changes if c.side != side]
+    def get_delta(self, side):
+        """Builds a delta (see :mod:`letssync.structures.delta`) from the
+        changes needed by the given side
+
+        Nodes involved in a conflict are left unchanged.
+        """
+        target = self.trees[side]
+        d = dict(added=[], removed=[], modified={})
+        for change in self.get_changes(side):
+            if change.kind == REMOVED:
+                d['removed'].append(change.relative_path)
+                continue
+            node = change.node
+            existing = target.search(change.relative_path)
+            if existing is None:
+                delta.add_subtree(node, d)
+            elif existing.__class__ is not node.__class__:
+                d['removed'].append(change.relative_path)
+                delta.add_subtree(node, d)
+            else:
+                changed = delta.get_changed_attrs(node, existing)
+                if len(changed):
+                    d['modified'][change.relative_path] = changed
+        return d
+    def apply(self, side):
+        """Applies the changes from the other side to the tree for
+        the given side
+
+        The tree must have been deserialized (see
+        :func:`letssync.structures.delta.apply_delta`)
+
+        Returns:
+            The root of the updated tree
+        """
+        return delta.apply_delta(self.trees[side], self.get_delta(side), verify=False)
+
+
+def merge(base, a, b, check_modes=True):
+    """Performs a three-way merge of two trees
+
+    Arguments:
+        base: The common ancestor of both trees, or any snapshot source
+            accepted by :meth:`letssync.structures.snapshot.Snapshot.load`
+        a: The tree for side ``'a'``
+        b: The tree for side ``'b'``
+        check_modes (bool): If :const:`False`, file modes are not compared
+            and subtrees with equal
+            :attr:`~letssync.structures.base.Path.tree_hash` values are
+            skipped. default is :const:`True`
+
+    Returns:
+        MergePlan
+    """
+    if not isinstance(base, Path):
+        from letssync.structures.snapshot import Snapshot
+        base = Snapshot.load(base).nodes['']
+    plan = MergePlan(base.root, a.root, b.root)
+    def node_equal(node, other):
+        if not node.node_equal(other):
+            return False
+        return not check_modes or node.mode_equal(other)
+    def subtree_equal(node, other):
+        if node.tree_hash != other.tree_hash:
+            return False
+        if not check_modes:
+            return True
+        def visit_modes(item):
+            if not item[0].mode_equal(item[1]):
+                return WALK_STOP
+        return walk_tree((node, other), visit_modes, get_children=zip_children)
+    def visit(item):
+        base_node, a_node, b_node = item
+        ref = base_node or a_node or b_node
+        rel_path = ref.relative_path
+        if a_node is not None and b_node is not None and not check_modes:
+            if a_node.tree_hash == b_node.tree_hash:
+                return WALK_SKIP
+        if base_node is None:
+            if a_node is None or b_node is None:
+                side = 'a' if b_node is None else 'b'
+                node = a_node or b_node
+                plan.changes.append(MergeChange(rel_path, ADDED, side, node, None))
+                return WALK_SKIP
+            if not node_equal(a_node, b_node):
+                plan.conflicts.append(Conflict(rel_path, BOTH_ADDED, None, a_node, b_node))
+                return WALK_SKIP
+            return
+        if a_node is None or b_node is None:
+            if a_node is None and b_node is None:
+                return WALK_SKIP
+            side = 'a' if a_node is None else 'b'
+            remaining = a_node or b_node
+            if subtree_equal(remaining, base_node):
+                plan.changes.append(MergeChange(rel_path, REMOVED, side, None, base_node))
+            else:
+                plan.conflicts.append(
+                    Conflict(rel_path, REMOVED_MODIFIED, base_node, a_node, b_node)
+                )
+            return WALK_SKIP
+        a_changed = not node_equal(base_node, a_node)
+        b_changed = not node_equal(base_node, b_node)
+        if a_changed and b_changed:
+            if not node_equal(a_node, b_node):
+                plan.conflicts.append(
+                    Conflict(rel_path, BOTH_MODIFIED, base_node, a_node, b_node)
+                )
+                return WALK_SKIP
+        elif a_changed or b_changed:
+            side = 'a' if a_changed else 'b'
+            node = a_node if a_changed else b_node
+            plan.changes.append(MergeChange(rel_path, MODIFIED, side, node, base_node))
+            if node.__class__ is not base_node.__class__:
+                return WALK_SKIP
+    walk_tree((plan.base, plan.trees['a'], plan.trees['b']), visit, get_children=zip_children)
+    return plan
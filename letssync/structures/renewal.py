@@ -1,6 +1,7 @@
 import sys
-import os
 import io
+import copy
+import json
 
 from configobj import ConfigObj
 
@@ -18,10 +19,21 @@ class Renewals(Directory):
             the configuration files as keys to the domains they are associated
             with as values (a :class:`list` of strings)
     """
+    __slots__ = ('domains', '_accounts')
     def __init__(self, **kwargs):
         self.domains = {}
-        self.accounts = {}
+        self._accounts = None
         super(Renewals, self).__init__(**kwargs)
+    @property
+    def accounts(self):
+        a = self._accounts
+        if a is None:
+            a = self._accounts = {}
+            for obj in self.domains.values():
+                if obj.account_id not in a:
+                    a[obj.account_id] = {}
+                a[obj.account_id][obj.domain] = obj
+        return a
     @classmethod
     def _child_class_override(cls, child_class, **kwargs):
         parent = kwargs.get('parent')
@@ -31,9 +43,19 @@ class Renewals(Directory):
         cls = RenewalConf
         obj = super(Renewals, self).add_child(cls, **kwargs)
         self.domains[obj.domain] = obj
-        if obj.account_id not in self.accounts:
-            self.accounts[obj.account_id] = {}
-        self.accounts[obj.account_id][obj.domain] = obj
+        self._accounts = None
+        return obj
+    def _post_clone(self):
+        super(Renewals, self)._post_clone()
+        self.domains = {}
+        self._accounts = None
+        for obj in self.children.values():
+            self.domains[obj.domain] = obj
+    def remove_child(self, key):
+        obj = super(Renewals, self).remove_child(key)
+        if self.domains.get(obj.domain) is obj:
+            del self.domains[obj.domain]
+        self._accounts = None
         return obj
 
 
@@ -43,36 +65,128 @@ class RenewalConf(FileObj):
     Attributes:
         account_id (str): The account_id contained in the config file
         domain (str): The domain name (discovered from the filename itself)
+        config: The parsed :class:`configobj.ConfigObj`
+        account: The :class:`~letssync.structures.account.Account` found
+            using :attr:`account_id`
     """
     serialize_attrs = ['account_id', 'domain']
+    __slots__ = ('_config', '_shared_config', '_account_id', 'domain')
     def read(self, **kwargs):
         super(RenewalConf, self).read(**kwargs)
+        self.config = kwargs.get('config')
+        # A config parsed by an earlier build is only copied if accessed
+        self._shared_config = kwargs.get('shared_config')
+        self._account_id = kwargs.get('account_id')
+        self.domain = kwargs.get('domain')
+        if self.domain is None:
+            self.domain = self.id.rstrip('.conf')
+        if not self.lazy:
+            self.account_id
+    def get_snapshot_kwargs(self):
+        kwargs = super(RenewalConf, self).get_snapshot_kwargs()
+        kwargs['domain'] = self.domain
+        config = self._config
+        if config is None:
+            config = getattr(self, '_shared_config', None)
+        if config is not None:
+            kwargs['shared_config'] = config
+        if self._account_id is not None:
+            kwargs['account_id'] = self._account_id
+        return kwargs
+    def parse_config(self):
         if PY2 and not isinstance(self.content, unicode):
             b = io.BytesIO(self.content)
         else:
             b = io.StringIO(self.content)
-        self.config = ConfigObj(b)
-        self.account_id = kwargs.get('account_id')
-        if self.account_id is None:
-            self.account_id = self.config['renewalparams']['account']
-        self.domain = kwargs.get('domain')
-        if self.domain is None:
-            self.domain = self.id.rstrip('.conf')
-    def on_tree_built(self):
+        return ConfigObj(b)
+    def _clone_attrs(self, source):
+        super(RenewalConf, self)._clone_attrs(source)
+        self._config = None
+        # A config not parsed yet is parsed from the copied content when needed
+        self._shared_config = getattr(source, '_config', None)
+        if self._shared_config is None:
+            self._shared_config = getattr(source, '_shared_config', None)
+    @property
+    def config(self):
+        c = self._config
+        if c is not None:
+            return c
+        shared = getattr(self, '_shared_config', None)
+        if shared is not None:
+            c = copy.deepcopy(shared)
+        else:
+            c = self.parse_config()
+        # Kept on the instance once handed out so changes made to it in
+        # place are never dropped (only the raw content is cached) and
+        # are included in the hashes
+        self._config = c
+        self._shared_config = None
+        self.mark_mutable()
+        return c
+    @config.setter
+    def config(self, value):
+        self._config = value
+        self._shared_config = None
+        self.invalidate_hash()
+        self.mark_dirty()
+        if value is not None:
+            self.mark_mutable()
+    def _get_config(self):
+        # Read-only access which does not copy a shared config (or keep a
+        # config parsed from the content of lazy trees)
+        c = self._config
+        if c is not None:
+            return c
+        shared = getattr(self, '_shared_config', None)
+        if shared is not None:
+            return shared
+        if self.lazy:
+            return self.parse_config()
+        return self.config
+    def get_hash_data(self):
+        # Skip FileObj content since only the config is used for equality
+        data = super(FileObj, self).get_hash_data()
+        data.append(json.dumps(self._get_config().dict(), sort_keys=True))
+        return data
+    @FileObj.content.setter
+    def content(self, value):
+        FileObj.content.fset(self, value)
+        # The config is parsed again from the new content when needed
+        self._config = None
+        self._shared_config = None
+    @property
+    def account_id(self):
+        a = self._account_id
+        if a is None:
+            a = self._account_id = self._get_config()['renewalparams']['account']
+        return a
+    @account_id.setter
+    def account_id(self, value):
+        self._account_id = value
+    @property
+    def account(self):
         accounts = self.root.children['accounts']
-        self.account = accounts.accounts.get(self.account_id)
-    def _write(self, overwrite=False):
-        p = self.path
-        if os.path.exists(p) and overwrite is False:
-            return
-        with open(self.path, 'wb') as f:
-            self.config.write(f)
+        return accounts.accounts.get(self.account_id)
+    def get_file_content(self):
+        """Retrieves the content to be written from :attr:`config`
+        """
+        b = io.BytesIO()
+        self._get_config().write(b)
+        return b.getvalue().decode('utf-8')
+    def _diff_attrs(self, other):
+        attrs = super(RenewalConf, self)._diff_attrs(other)
+        if 'content' in attrs:
+            attrs.remove('content')
+        if self._get_config().dict() != other._get_config().dict():
+            attrs.append('config')
+        return attrs
+    def _get_content_diff(self, other, other_name):
+        # The parsed config is compared instead
+        return None
     def _get_diff(self, other, other_name):
         d = super(RenewalConf, self)._get_diff(other, other_name)
         if other is None:
             return d
-        if 'content' in d:
-            del d['content']
         cdiff = {}
         def on_walk(section, key, **kwargs):
             name = kwargs.get('name')
@@ -89,12 +203,12 @@ class RenewalConf(FileObj):
             else:
                 cdiff[section.name][key] = {}
             cdiff[section.name][key][name] = val
-        self.config.walk(on_walk, name=self.name)
-        other.config.walk(on_walk, name=other_name)
+        self._get_config().walk(on_walk, name=self.name)
+        other._get_config().walk(on_walk, name=other_name)
         if len(cdiff):
             d['config'] = cdiff
         return d
     def __eq__(self, other):
         if not isinstance(other, RenewalConf):
             return False
-        return self.config.dict() == other.config.dict()
+        return self._get_config().dict() == other._get_config().dict()
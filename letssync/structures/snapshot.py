@@ -0,0 +1,100 @@
+from letssync.structures import binary
+from letssync.structures.base import Path
+
+
+class Snapshot(object):
+    """A previously built tree used to speed up a new build
+
+    Nodes whose (inode, size, modified) values match the filesystem are not
+    read again. Their content and parsed data are reused instead.
+
+    Attributes:
+        nodes (dict): The nodes of the previous tree with their
+            :attr:`~letssync.structures.base.Path.relative_path` as keys
+    """
+    def __init__(self, tree):
+        self.nodes = {}
+        self._add_node(tree.root)
+    def _add_node(self, node):
+        self.nodes[node.relative_path] = node
+        for child in node.children.values():
+            self._add_node(child)
+    @classmethod
+    def load(cls, source):
+        """Creates a :class:`Snapshot` from the given source
+
+        Arguments:
+            source: Either a :class:`~letssync.structures.base.Path` instance,
+                a JSON string (as text or :class:`bytes`) as produced by
+                :meth:`~letssync.structures.base.Path.to_json`, binary data
+                from :meth:`~letssync.structures.base.Path.to_binary` or the
+                filename of a snapshot written by :func:`save`
+        """
+        if isinstance(source, Snapshot):
+            return source
+        if isinstance(source, Path):
+            return cls(source)
+        if isinstance(source, bytes):
+            if source.startswith(binary.MAGIC):
+                return cls(Path.from_binary(source))
+            # JSON (or a filename) given as bytes
+            source = source.decode('utf-8')
+        if not source.lstrip().startswith('{'):
+            with open(source, 'rb') as f:
+                data = f.read()
+            if data.startswith(binary.MAGIC):
+                return cls(Path.from_binary(data))
+            source = data.decode('utf-8')
+        return cls(Path.from_json(source))
+    def get_node(self, relative_path, st):
+        """Searches for an unchanged node
+
+        Arguments:
+            relative_path (str): The node's path relative to the root
+            st: The current :func:`os.stat` result for the node
+
+        Returns:
+            The previous :class:`~letssync.structures.base.Path` instance if
+            its inode, size and modified time match, otherwise :const:`None`
+        """
+        node = self.nodes.get(relative_path)
+        if node is None:
+            return None
+        if node.inode != st.st_ino or node.size != st.st_size:
+            return None
+        if node.modified != st.st_mtime:
+            return None
+        return node
+    def get_kwargs(self, relative_path, st):
+        """Builds the keyword arguments for a new node from its stat result
+
+        The stat values are always included (so the node does not need to
+        stat again). If the node is unchanged, data from
+        :meth:`~letssync.structures.base.Path.get_snapshot_kwargs` is added.
+        """
+        kwargs = dict(
+            mode=st.st_mode,
+            modified=st.st_mtime,
+            inode=st.st_ino,
+            size=st.st_size,
+        )
+        node = self.get_node(relative_path, st)
+        if node is not None:
+            kwargs.update(node.get_snapshot_kwargs())
+        return kwargs
+
+def save(tree, filename, use_binary=False):
+    """Writes the given tree to a file to be used later as a :class:`Snapshot`
+
+    Arguments:
+        tree: The tree to save
+        filename (str): The filename to write to
+        use_binary (bool): If :const:`True`, the binary format from
+            :mod:`letssync.structures.binary` is used. Otherwise JSON
+    """
+    if use_binary:
+        with open(filename, 'wb') as f:
+            binary.dump(tree, f)
+    else:
+        with open(filename, 'w') as f:
+            tree.dump(f)
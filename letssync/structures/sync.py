@@ -0,0 +1,287 @@
+"""Planning the filesystem operations needed to sync a tree
+
+:func:`plan_sync` compares a source tree with the tree currently at the
+destination and builds a :class:`SyncPlan` holding the minimal list of
+:class:`Operation` objects needed to bring the destination up to date.
+
+Redundant steps are collapsed while planning:
+
+* A removed subtree is deleted once from its top directory
+* Created directories and written files are given their mode directly,
+  so no separate :data:`CHMOD` is needed for them
+* A :data:`CHMOD` is only planned when the mode alone has changed
+* A node replaced by one of a different type (such as a file replaced by
+  a directory) is deleted and created again, without visiting the
+  removed children
+
+Operations are ordered in phases (see :data:`PHASES`) with parents before
+their children in each phase. The plan can be shown as a dry run
+(:meth:`SyncPlan.describe`) or executed, in which case only the paths
+involved are touched.
+"""
+import os
+import stat
+
+from letssync.structures import fsio
+from letssync.structures.base import (
+    Directory, Link, WALK_SKIP, walk_tree, to_bytes, zip_children,
+)
+
+MKDIR = 'mkdir'
+WRITE = 'write'
+CHMOD = 'chmod'
+SYMLINK = 'symlink'
+DELETE = 'delete'
+
+PHASES = (DELETE, MKDIR, WRITE, CHMOD, SYMLINK)
+"""The order operations are performed in
+
+Links are created last so their targets exist when they are made.
+"""
+
+
+class Operation(object):
+    """A single filesystem operation
+
+    Attributes:
+        op (str): One of :data:`MKDIR`, :data:`WRITE`, :data:`CHMOD`,
+            :data:`SYMLINK` or :data:`DELETE`
+        relative_path (str): The path relative to the destination root
+        path (str): The destination path (:const:`None` if the plan has no
+            root path)
+        mode (int): The permission bits to set (:const:`None` if not needed)
+        node: The source node (:const:`None` for :data:`DELETE`)
+        target (str): The link target for :data:`SYMLINK`
+        size (int): The number of bytes written for :data:`WRITE`
+    """
+    def __init__(self, op, relative_path, path=None, mode=None, node=None,
+                 target=None, size=0):
+        self.op = op
+        self.relative_path = relative_path
+        self.path = path
+        self.mode = mode
+        self.node = node
+        self.target = target
+        self.size = size
+    def describe(self):
+        """A single line describing the operation
+        """
+        s = '{0} {1}'.format(self.op, self.relative_path)
+        if self.op == SYMLINK:
+            s = '{0} -> {1}'.format(s, self.target)
+        if self.mode is not None:
+            s = '{0} ({1:o})'.format(s, self.mode)
+        if self.op == WRITE:
+            s = '{0} [{1} bytes]'.format(s, self.size)
+        return s
+    def execute(self, writer=fsio):
+        """Performs the operation
+
+        Arguments:
+            writer: The :class:`~letssync.structures.fsio.BatchWriter` to use.
+                If not given, the :mod:`~letssync.structures.fsio` module
+                functions are used
+        """
+        p = self.path
+        if p is None:
+            raise ValueError('No destination path for {0}'.format(self.relative_path))
+        if self.op == DELETE:
+            writer.remove(p)
+        elif self.op == MKDIR:
+            writer.makedirs(p, self.mode)
+        elif self.op == WRITE:
+            writer.write_file(p, self.node.get_file_content(), self.mode)
+        elif self.op == SYMLINK:
+            writer.symlink(self.target, p)
+        elif self.op == CHMOD:
+            writer.chmod(p, self.mode)
+    def __repr__(self):
+        return '<{0}: {1}>'.format(self.__class__.__name__, self.describe())
+
+
+class SyncPlan(object):
+    """The result of :func:`plan_sync`
+
+    Attributes:
+        source: The root of the source tree
+        dest: The root of the destination tree
+        root_path (str): The destination root on the filesystem
+        operations (list): The :class:`Operation` objects in the order
+            they are performed
+    """
+    def __init__(self, source, dest, root_path=None):
+        self.source = source
+        self.dest = dest
+        self.root_path = root_path
+        self.operations = []
+    @property
+    def bytes_written(self):
+        """The estimated number of bytes written by the plan
+        """
+        return sum(op.size for op in self.operations)
+    def get_operations(self, op):
+        """Retrieves the operations of the given type
+        """
+        return [o for o in self.operations if o.op == op]
+    def describe(self):
+        """Describes the plan without performing any operations (a dry run)
+
+        Returns:
+            list: A line for each operation (see :meth:`Operation.describe`)
+        """
+        return [op.describe() for op in self.operations]
+    def execute(self, dry_run=False, fsync=True, workers=None):
+        """Performs each operation in order
+
+        Files and links are replaced atomically and the changed directories
+        are synced once all operations are done (see
+        :class:`~letssync.structures.fsio.BatchWriter`).
+
+        Arguments:
+            dry_run (bool): If :const:`True`, nothing is performed and
+                only the description is returned
+            fsync (bool): If :const:`False`, the changes are not synced to
+                disk. default is :const:`True`
+            workers (int): If given, the operations are performed using this
+                many threads (see :class:`~letssync.structures.fsio.WriteExecutor`).
+                Operations still wait for any earlier ones on the same path,
+                on its parent directory and (for links) on their target
+
+        Returns:
+            list: The result of :meth:`describe`
+        """
+        if not dry_run:
+            with fsio.BatchWriter(fsync) as writer:
+                if workers is None:
+                    for op in self.operations:
+                        op.execute(writer)
+                else:
+                    self._execute_parallel(writer, workers)
+        return self.describe()
+    def _execute_parallel(self, writer, workers):
+        executor = fsio.WriteExecutor(workers)
+        by_path = {}
+        for i, op in enumerate(self.operations):
+            depends = list(by_path.get(op.relative_path, []))
+            paths = [os.path.dirname(op.relative_path)]
+            if op.op == SYMLINK:
+                target = os.path.join(os.path.dirname(op.relative_path), op.target)
+                paths.append(os.path.normpath(target))
+            for p in paths:
+                depends.extend(by_path.get(p, []))
+            executor.add(i, op.execute, (writer,), depends)
+            by_path.setdefault(op.relative_path, []).append(i)
+        executor.run()
+    def __len__(self):
+        return len(self.operations)
+    def __iter__(self):
+        return iter(self.operations)
+
+
+def _get_kind(node):
+    if isinstance(node, Directory):
+        return MKDIR
+    if isinstance(node, Link):
+        return SYMLINK
+    return WRITE
+
+def _get_mode(node):
+    if node.mode is None:
+        return None
+    return stat.S_IMODE(node.mode)
+
+def _get_link_target(node):
+    p = node.linked_path
+    if not os.path.isabs(p):
+        return p
+    # Absolute links are made relative so they point inside the destination
+    return os.path.relpath(
+        node.linked_relative_path, os.path.dirname(node.relative_path) or os.curdir,
+    )
+
+def _get_children(item):
+    # Items are lists of [source, dest, same] so "same" can be set by visit
+    src, dst, same = item
+    if src is None:
+        return []
+    if dst is not None and _get_kind(dst) != _get_kind(src):
+        # Replaced, so the children of dst were removed along with it
+        dst = None
+    return [
+        [child, dst_child, same and dst_child is not None]
+        for child, dst_child in zip_children((src, dst))
+    ]
+
+def plan_sync(source, dest, root_path=None, check_modes=True):
+    """Plans the operations needed to make the destination match the source
+
+    Arguments:
+        source: The tree to sync from
+        dest: The tree currently at the destination (built from the
+            filesystem or loaded from a snapshot of it)
+        root_path (str): The destination root on the filesystem.
+            If not given, the :attr:`~letssync.structures.base.Path.path`
+            of the ``dest`` root is used
+        check_modes (bool): If :const:`False`, subtrees with equal
+            :attr:`~letssync.structures.base.Path.tree_hash` values are
+            skipped without comparing file modes. default is :const:`True`
+
+    Returns:
+        SyncPlan
+    """
+    if root_path is None:
+        root_path = dest.root.path
+    plan = SyncPlan(source.root, dest.root, root_path)
+    phases = dict((op, []) for op in PHASES)
+    def get_path(node):
+        if root_path is None:
+            return None
+        if not node.relative_path:
+            return root_path
+        return os.path.join(root_path, node.relative_path)
+    def add_create(node):
+        path = get_path(node)
+        kind = _get_kind(node)
+        rel_path = node.relative_path
+        if kind == SYMLINK:
+            op = Operation(SYMLINK, rel_path, path, node=node,
+                           target=_get_link_target(node))
+        elif kind == MKDIR:
+            op = Operation(MKDIR, rel_path, path, _get_mode(node), node)
+        else:
+            size = len(to_bytes(node.get_file_content()))
+            op = Operation(WRITE, rel_path, path, _get_mode(node), node, size=size)
+        phases[kind].append(op)
+    def visit(item):
+        src, dst, same = item
+        if src is None:
+            phases[DELETE].append(Operation(DELETE, dst.relative_path, get_path(dst)))
+            return WALK_SKIP
+        if dst is None:
+            add_create(src)
+            return
+        kind = _get_kind(src)
+        if _get_kind(dst) != kind:
+            phases[DELETE].append(Operation(DELETE, dst.relative_path, get_path(dst)))
+            add_create(src)
+            return
+        if not same and src.tree_hash == dst.tree_hash:
+            if not check_modes:
+                return WALK_SKIP
+            same = item[2] = True
+        if kind == SYMLINK:
+            if not same and src.linked_relative_path != dst.linked_relative_path:
+                add_create(src)
+            return
+        if kind == WRITE and not same and not src.node_equal(dst):
+            add_create(src)
+            return
+        mode = _get_mode(src)
+        if mode is not None and not src.mode_equal(dst):
+            phases[CHMOD].append(
+                Operation(CHMOD, src.relative_path, get_path(src), mode, src)
+            )
+    walk_tree([source, dest, False], visit, get_children=_get_children)
+    for op in PHASES:
+        plan.operations.extend(phases[op])
+    return plan
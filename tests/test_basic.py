@@ -51,3 +51,393 @@ def test_serialization(conf_dir):
     js_str = r1.to_json()
     r2 = Path.from_json(js_str)
     assert r1.is_equal(r2) and r2.is_equal(r1)
+
+def test_stream_serialization(conf_dir):
+    import io
+    import json
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    from letssync.structures import jsonstream
+    r1 = build_tree(str(conf_dir['root_path']))
+    for indent in [None, 2]:
+        fp = io.StringIO()
+        r1.dump(fp, indent=indent)
+        s = fp.getvalue()
+        if indent is None:
+            assert '\n' not in s
+        assert json.loads(s) == json.loads(r1.to_json())
+        r2 = Path.load(io.StringIO(s))
+        assert r1.is_equal(r2) and r2.is_equal(r1)
+        reader_chunk = jsonstream.CHUNK_SIZE
+        jsonstream.CHUNK_SIZE = 7
+        try:
+            r3 = Path.load(io.StringIO(s))
+        finally:
+            jsonstream.CHUNK_SIZE = reader_chunk
+        assert r1.is_equal(r3) and r3.is_equal(r1)
+    r4 = Path.load(io.StringIO(r1.to_json()))
+    assert r1.is_equal(r4) and r4.is_equal(r1)
+
+def test_binary_serialization(multi_conf_two_accounts):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    from letssync.structures import binary
+    r1 = build_tree(str(multi_conf_two_accounts['new_account']['root_path']))
+    data = r1.to_binary()
+    assert data.startswith(binary.MAGIC)
+    assert len(data) < len(r1.to_json()) // 4
+    r2 = Path.from_binary(data)
+    assert r1.is_equal(r2) and r2.is_equal(r1)
+    assert r1.tree_hash == r2.tree_hash
+    r3 = Path.from_binary(r1.to_binary(compress=False))
+    assert r1.is_equal(r3) and r3.is_equal(r1)
+
+def test_binary_dedup():
+    from letssync.structures import binary
+    pem = '-----BEGIN CERTIFICATE-----\nabc\n-----END CERTIFICATE-----\n'
+    ca = '-----BEGIN CERTIFICATE-----\nxyz\n-----END CERTIFICATE-----\n'
+    fullchain = '\n'.join([pem, ca])
+    assert binary.split_chunks(fullchain) == [pem, '\n', ca]
+    assert ''.join(binary.split_chunks('foo')) == 'foo'
+    assert binary.split_chunks('') == ['']
+    store = binary.BlobStore()
+    indices = [store.add(c) for c in binary.split_chunks(pem)]
+    indices.extend(store.add(c) for c in binary.split_chunks(fullchain))
+    assert len(store.blobs) == 3
+    assert indices == [0, 0, 1, 2]
+
+def test_copy_sharing(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    from letssync.structures.fsio import io_counter
+    r1 = build_tree(str(conf_dir['root_path']))
+    r2 = r1.copy()
+    assert r2.tree_hash == r1.tree_hash
+    account = r1.search('accounts').accounts[conf_dir['account_id']]
+    account2 = r2.search('accounts').accounts[conf_dir['account_id']]
+    assert account2 is not account
+    assert account2.root is r2
+    assert set(account2.domains) == set(account.domains)
+    for domain in conf_dir['domains']:
+        fn = 'archive/{}/cert1.pem'.format(domain)
+        assert r2.search(fn).content is r1.search(fn).content
+        link = r2.search('live/{}/cert.pem'.format(domain))
+        assert link.linked_obj is r2.search(fn)
+        conf = r2.search('renewal').domains[domain]
+        assert conf.root is r2
+        assert conf.account is account2
+    meta = r1.search(account.relative_path).search('meta.json')
+    meta2 = account2.search('meta.json')
+    assert meta2._shared_data is meta.data
+    meta2.data['foo'] = 'bar'
+    meta2.invalidate_hash()
+    assert 'foo' not in meta.data
+    assert not r1.is_equal(r2)
+    assert r1.search('live').is_equal(r2.search('live'))
+    h = r2.tree_hash
+    meta2.data = dict(meta.data)
+    assert r2.tree_hash != h
+    assert r1.is_equal(r2)
+    conf = r2.search('renewal').domains[conf_dir['domains'][0]]
+    r2.tree_hash
+    conf.config = conf.parse_config()
+    assert r2._tree_hash is None
+    assert r1.is_equal(r2)
+
+    # Copies of lazy trees stay unread until the contents are needed
+    r3 = build_tree(str(conf_dir['root_path']), lazy=True)
+    with io_counter:
+        r6 = r3.copy()
+    assert io_counter['read'] == 0
+    assert r6.tree_hash == r3.tree_hash
+    for domain in conf_dir['domains']:
+        fn = 'archive/{}/cert1.pem'.format(domain)
+        assert r6.search(fn).content == r1.search(fn).content
+    assert r6.search(meta.relative_path).data == meta.data
+    t = tmpdir_factory.mktemp('copy')
+    with io_counter:
+        r4 = r3.copy(str(t))
+    assert io_counter['read'] == 0
+    r4.write()
+    r5 = build_tree(str(t))
+    assert r1.is_equal(r5) and r5.is_equal(r1)
+
+    archive = r1.search('archive').copy()
+    assert archive.parent is None
+    assert archive.relative_path == ''
+    assert set(archive.children.keys()) == set(conf_dir['domains'])
+    assert archive.is_equal(r1.search('archive').copy())
+
+def test_path_index(conf_dir):
+    from letssync.structures import build_tree
+    r1 = build_tree(str(conf_dir['root_path']))
+    nodes = list(r1.iter_subtree())
+    assert len(r1.path_index) == len(nodes)
+    for node in nodes:
+        assert r1.path_index[node.relative_path] is node
+        if node is not r1:
+            assert r1.search(node.relative_path) is node
+            assert node.parent.search(node.id) is node
+    assert r1.search('') is None
+    assert r1.search('foo') is None
+    assert r1.search(['archive', conf_dir['domains'][0]]) is r1.search('archive').search(conf_dir['domains'][0])
+    domain = conf_dir['domains'][0]
+    for fn in ['cert', 'chain', 'fullchain', 'privkey']:
+        link = r1.search('live/{}/{}.pem'.format(domain, fn))
+        assert link.linked_obj is r1.search('archive/{}/{}1.pem'.format(domain, fn))
+
+    r2 = r1.copy()
+    assert r2.search('archive') is not r1.search('archive')
+    assert r2.search('archive').root is r2
+
+    archive_dir = r2.search('archive').remove_child(domain)
+    assert r2.search('archive/{}'.format(domain)) is None
+    assert r2.search('archive/{}/cert1.pem'.format(domain)) is None
+    renamed = r2.search('live').add_existing_child(archive_dir)
+    assert r2.search('live/{}/cert1.pem'.format(domain)) is renamed.children['cert1.pem']
+    assert renamed.children['cert1.pem'].relative_path == 'live/{}/cert1.pem'.format(domain)
+    assert r2.search('live/{}/cert.pem'.format(domain)) is None
+    assert len(r2.path_index) == len(list(r2.iter_subtree()))
+
+def test_cached_root(conf_dir):
+    from letssync.structures import build_tree
+    r1 = build_tree(str(conf_dir['root_path']))
+    r1.name = 'r1'
+    for node in r1.iter_subtree():
+        assert node.root is r1
+        assert node.name == 'r1'
+    archive = r1.search('archive').copy()
+    archive.name = 'archive'
+    for node in archive.iter_subtree():
+        assert node.root is archive
+        assert node.name == 'archive'
+        assert node.is_serialized
+    domain = conf_dir['domains'][0]
+    domain_dir = archive.children[domain]
+    r2 = r1.copy()
+    r2.name = 'r2'
+    r2.search('live').add_existing_child(domain_dir)
+    for node in domain_dir.iter_subtree():
+        assert node.root is r2
+        assert node.name == 'r2'
+        assert node.relative_path.startswith('live/{}'.format(domain))
+        assert node.path == os.path.join(r2.path, node.relative_path)
+
+def test_class_registry(conf_dir):
+    import gc
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path, PathMeta, Directory
+    from letssync.structures.account import Accounts
+    assert Path.find_subclass('Accounts') is Accounts
+    assert Path.find_subclass('NotAClass') is None
+    chain = Directory.get_override_chain()
+    assert Directory.get_override_chain() is chain
+    assert Accounts._child_class_override in chain
+
+    class CustomDirectory(Directory):
+        @classmethod
+        def _child_class_override(cls, child_class, **kwargs):
+            parent = kwargs.get('parent')
+            if kwargs.get('id') == 'custom' and parent.parent is None:
+                return cls
+
+    r = None
+    try:
+        assert Directory not in PathMeta.override_chains
+        assert Path.find_subclass('CustomDirectory') is CustomDirectory
+        assert Directory.get_override_chain()[0] == CustomDirectory._child_class_override
+        conf_dir['root_path'].mkdir('custom')
+        r = build_tree(str(conf_dir['root_path']))
+        assert isinstance(r.search('custom'), CustomDirectory)
+        assert isinstance(r.search('accounts'), Accounts)
+    finally:
+        # Remove the class so it does not affect other tests
+        PathMeta.registry.pop('CustomDirectory', None)
+        PathMeta.override_chains.clear()
+        del CustomDirectory, r
+        gc.collect()
+    assert Path.find_subclass('CustomDirectory') is None
+    assert Directory.get_override_chain() == chain
+
+def test_serialize_attrs(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path, FileObj, Link
+    from letssync.structures.account import Account
+    attrs = Account.get_serialize_attrs()
+    assert Account.get_serialize_attrs() is attrs
+    assert attrs == tuple(Path.serialize_attrs + Account.serialize_attrs)
+    assert FileObj.get_serialize_attrs()[-1] == 'content'
+    r = build_tree(str(conf_dir['root_path']))
+    for node in r.iter_subtree():
+        d = node._serialize()
+        expected = {attr: getattr(node, attr) for attr in node.get_serialize_attrs()}
+        expected['class_name'] = node.__class__.__name__
+        if node.parent is None:
+            expected['name'] = node.name
+        assert d == expected
+        if isinstance(node, Link):
+            assert d['linked_path'] == node.linked_path
+
+def test_compact_nodes(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    r2 = Path.from_json(r1.to_json())
+    for node in r2.iter_subtree():
+        assert not hasattr(node, '__dict__')
+        if node.parent is not None:
+            assert node.path == os.path.join(root_path, node.relative_path)
+    f1 = r1.search('accounts').children
+    f2 = r2.search('accounts').children
+    for key in f1:
+        assert f1[key].id is f2[key].id
+
+    r2.path = '/tmp/moved'
+    archive = r2.search('archive')
+    assert archive.path == '/tmp/moved/archive'
+    archive.path = '/tmp/ignored'
+    assert archive.path == '/tmp/moved/archive'
+    a_copy = archive.copy()
+    assert a_copy.path == '/tmp/moved/archive'
+    for node in a_copy.iter_subtree():
+        if node.parent is not None:
+            assert node.path == os.path.join(a_copy.path, node.relative_path)
+
+def test_walk():
+    import sys
+    from letssync.structures.base import Directory, WALK_SKIP, WALK_STOP
+
+    def build(depth):
+        kw = dict(mode=0o40755, modified=1.0, is_serialized=True)
+        r = obj = Directory(path='/tmp/deep', **kw)
+        obj.add_child(Directory, path='/tmp/deep/x', **kw)
+        for i in range(depth):
+            obj = obj.add_child(Directory, path=os.path.join(obj.path, 'd'), **kw)
+        return r, obj
+
+    r, leaf = build(3)
+    pre, post = [], []
+    r.walk(lambda n: pre.append(n.relative_path), lambda n: post.append(n.relative_path))
+    assert pre == ['', 'x', 'd', 'd/d', 'd/d/d']
+    assert post == ['x', 'd/d/d', 'd/d', 'd', '']
+    seen = []
+    def skip(node):
+        seen.append(node.relative_path)
+        if node.id == 'd':
+            return WALK_SKIP
+    assert r.walk(skip) is True
+    assert seen == ['', 'x', 'd']
+    assert r.walk(lambda n: WALK_STOP if n.id == 'x' else None) is False
+
+    # Deeper than the recursion limit
+    depth = sys.getrecursionlimit() + 100
+    r1, leaf1 = build(depth)
+    r2, leaf2 = build(depth)
+    r1.name, r2.name = 'r1', 'r2'
+    d = r1.serialize()
+    for i in range(depth):
+        d = d['children']['d']
+    assert d['path'] == leaf1.path
+    r1.on_tree_built()
+    assert r1.is_equal(r2)
+    assert r1.is_equal(r2, metadata_only=True)
+    assert r1.get_diff(r2) == {}
+    leaf2.add_child(Directory, path=os.path.join(leaf2.path, 'new'),
+                    mode=0o40755, modified=1.0)
+    assert not r1.is_equal(r2)
+    diff = r1.get_diff(r2)
+    assert list(diff.keys()) == [leaf2.relative_path + '/new']
+
+def test_dirty_tracking(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    d0, d1 = sorted(conf_dir['domains'])
+    r1 = build_tree(str(conf_dir['root_path']))
+    assert not r1.is_dirty
+    assert Path.from_json(r1.to_json()).is_dirty
+
+    t = tmpdir_factory.mktemp('dirty')
+    r2 = r1.copy(str(t))
+    assert r2.search('archive/{}/cert1.pem'.format(d0)).is_dirty
+    r2.write()
+    assert not r2.is_dirty
+
+    privkey = r2.search('archive/{}/privkey1.pem'.format(d0))
+    chain = r2.search('archive/{}/chain1.pem'.format(d0))
+    privkey.content = 'changed\n'
+    chain.mode = 0o100600
+    assert privkey.is_dirty and privkey.parent.is_dirty and r2.is_dirty
+    assert not r2.search('archive/{}'.format(d1)).is_dirty
+    assert not r2.search('live').is_dirty
+
+    # Clean nodes are not written, even with overwrite set
+    other = r2.search('archive/{}/cert1.pem'.format(d1))
+    with open(other.path, 'w') as f:
+        f.write('external\n')
+    r2.write(overwrite=False)
+    assert privkey.is_dirty
+    r2.write(overwrite=True)
+    assert not r2.is_dirty
+    with open(privkey.path, 'r') as f:
+        assert f.read() == 'changed\n'
+    assert os.stat(chain.path).st_mode == 0o100600
+    with open(other.path, 'r') as f:
+        assert f.read() == 'external\n'
+
+    renewal = r2.search('renewal/{}.conf'.format(d0))
+    config = renewal.config
+    config['renewalparams']['account'] = 'abc'
+    renewal.config = config
+    link = r2.search('live/{}/cert.pem'.format(d0))
+    link.linked_path = '../../archive/{}/chain1.pem'.format(d0)
+    r2.write(overwrite=True)
+    assert os.readlink(link.path) == link.linked_path
+    r3 = build_tree(str(t))
+    assert r3.search('renewal/{}.conf'.format(d0)).account_id == 'abc'
+
+    # Parsed data changed in place (without a setter) is found and written
+    assert not r3.is_dirty
+    config = r3.search('renewal/{}.conf'.format(d0)).config
+    config['renewalparams']['account'] = 'def'
+    meta = r3.search('accounts').accounts[conf_dir['account_id']].children['meta.json']
+    data = meta.data
+    assert r3.is_dirty
+    r3.write(overwrite=True)
+    assert not r3.is_dirty
+    data['letssync_test'] = 'foo'
+    assert meta.is_dirty and r3.is_dirty
+    r3.write(overwrite=True, workers=2)
+    assert not r3.is_dirty
+    r4 = build_tree(str(t))
+    assert r4.search('renewal/{}.conf'.format(d0)).account_id == 'def'
+    assert r4.search(meta.relative_path).data['letssync_test'] == 'foo'
+
+def test_dirty_relocation(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    d0, d1 = sorted(conf_dir['domains'])
+    t = tmpdir_factory.mktemp('relocate')
+    build_tree(str(conf_dir['root_path'])).copy(str(t)).write()
+
+    # A clean subtree moved into a clean tree
+    r1 = build_tree(str(t))
+    domain = build_tree(str(t)).search('archive/{}'.format(d0)).copy()
+    domain.id = 'moved.example.com'
+    r1.search('archive').add_existing_child(domain)
+    assert r1.is_dirty and domain.is_dirty
+    assert domain.children['cert1.pem'].is_dirty
+    assert not r1.search('live').is_dirty
+    r1.write()
+    assert not r1.is_dirty
+    moved = build_tree(str(t)).search('archive/moved.example.com')
+    assert moved is not None
+    assert moved.children['cert1.pem'].content == domain.children['cert1.pem'].content
+
+    # Setting a new root path
+    t2 = tmpdir_factory.mktemp('relocate_root')
+    r2 = build_tree(str(t))
+    r2.path = str(t)
+    assert not r2.is_dirty
+    r2.path = str(t2)
+    assert r2.search('archive/{}/cert1.pem'.format(d0)).is_dirty
+    r2.write()
+    assert build_tree(str(t2)).is_equal(build_tree(str(t)))
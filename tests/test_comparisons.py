@@ -71,3 +71,195 @@ def test_multi_account(multi_conf_two_accounts):
         val = diff[key]
         assert val['class_name']['new_account'] is not None
         assert val['class_name']['base'] is None
+
+def test_tree_hash(multi_conf_renewal_out_of_sync):
+    from letssync.structures import build_tree
+    base = multi_conf_renewal_out_of_sync['base']
+    renewed = multi_conf_renewal_out_of_sync['renewed']
+    r1 = build_tree(str(base['root_path']))
+    r2 = build_tree(str(renewed['root_path']))
+    r3 = r1.copy()
+    assert r1.tree_hash == r3.tree_hash
+    assert r1.get_diff(r3) == {}
+    assert r1.tree_hash != r2.tree_hash
+    assert r1.search('accounts').tree_hash == r2.search('accounts').tree_hash
+    assert r1.search('live').tree_hash != r2.search('live').tree_hash
+
+    domain = base['domains'][0]
+    fn = os.path.join('archive', domain, 'cert1.pem')
+    prev_hashes = {key: child.tree_hash for key, child in r3.children.items()}
+    prev_root_hash = r3.tree_hash
+    r3.search(fn).content = 'foo'
+    assert r3.tree_hash != prev_root_hash
+    for key, child in r3.children.items():
+        if key == 'archive':
+            assert child.tree_hash != prev_hashes[key]
+        else:
+            assert child.tree_hash == prev_hashes[key]
+    assert not r1.is_equal(r3)
+    assert list(r1.get_diff(r3).keys()) == [fn]
+
+def test_tree_hash_in_place(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.account import AccountFile
+    root_path = str(conf_dir['root_path'])
+    domain = conf_dir['domains'][0]
+    conf_fn = 'renewal/{}.conf'.format(domain)
+    for lazy in [False, True]:
+        r1 = build_tree(root_path, lazy=lazy)
+        r2 = build_tree(root_path, lazy=lazy)
+        conf = r2.search(conf_fn)
+        config = conf.config
+        assert r1.tree_hash == r2.tree_hash
+        assert r1.is_equal(r2)
+
+        # Parsed data handed out earlier is changed without a setter
+        config['renewalparams']['account'] = 'other'
+        assert conf != r1.search(conf_fn)
+        assert not r1.is_equal(r2)
+        assert list(r1.get_diff(r2).keys()) == [conf_fn]
+        assert r1.tree_hash != r2.tree_hash
+        r3 = r2.copy()
+        assert r3.tree_hash == r2.tree_hash
+        assert not r1.is_equal(r3)
+
+        config['renewalparams']['account'] = conf_dir['account_id']
+        assert r1.is_equal(r2)
+        meta = [n for n in r2.search('accounts').iter_subtree()
+                if isinstance(n, AccountFile)][0]
+        r2.tree_hash
+        meta.data['letssync_test'] = 'foo'
+        assert not r1.is_equal(r2)
+        assert list(r1.get_diff(r2).keys()) == [meta.relative_path]
+
+def test_iter_diff(multi_conf_renewal_out_of_sync):
+    from letssync.structures import build_tree, diff
+    base = multi_conf_renewal_out_of_sync['base']
+    renewed = multi_conf_renewal_out_of_sync['renewed']
+    r1 = build_tree(str(base['root_path']))
+    r2 = build_tree(str(renewed['root_path']))
+    r1.name = 'base'
+    r2.name = 'renewed'
+    changes = list(r1.iter_diff(r2))
+    full = r1.get_diff(r2)
+    assert [c.relative_path for c in changes] == list(full.keys())
+    for change in changes:
+        assert change.get_diff() == full[change.relative_path]
+        if change.relative_path.startswith('live'):
+            assert change.kind == diff.MODIFIED
+            assert change.attrs == ['linked_path']
+        elif change.relative_path.startswith('archive'):
+            assert change.kind == diff.ADDED
+            assert change.get_values('content')[0] is None
+        else:
+            assert change.attrs == ['config']
+        assert list(change.unified_diff()) == []
+
+    domain = base['domains'][0]
+    fn = 'archive/{}/cert1.pem'.format(domain)
+    r1.search(fn).content = 'foo\nbar\n'
+    r3 = r1.copy()
+    r3.name = 'changed'
+    r3.search(fn).content = 'foo\nbaz\n'
+    r3.search('archive/{}'.format(domain)).remove_child('chain1.pem')
+    changes = list(r1.iter_diff(r3))
+    assert [(c.kind, c.relative_path) for c in changes] == [
+        (diff.MODIFIED, fn),
+        (diff.REMOVED, 'archive/{}/chain1.pem'.format(domain)),
+    ]
+    lines = list(changes[0].unified_diff())
+    assert lines[:2] == ['--- base', '+++ changed']
+    assert lines[-2:] == ['-bar', '+baz']
+
+def test_bounded_content_diff(conf_dir):
+    from letssync.structures import build_tree, diff
+    r1 = build_tree(str(conf_dir['root_path']))
+    r1.name = 'a'
+    r2 = r1.copy()
+    r2.name = 'b'
+    domain = conf_dir['domains'][0]
+    cert = 'archive/{}/cert1.pem'.format(domain)
+    chain = 'archive/{}/privkey1.pem'.format(domain)
+    r2.search(cert).content = r1.search(chain).content
+    d = r1.get_diff(r2)
+    assert list(d.keys()) == [cert]
+    content = d[cert]['content']
+    assert set(content.keys()) == {'a', 'b'}
+    assert content['a'] == diff.summarize(r1.search(cert).content)
+    assert content['b']['sha256'] == diff.summarize(r1.search(chain).content)['sha256']
+
+    old_lines = ['line {}'.format(i) for i in range(100)]
+    new_lines = ['changed {}'.format(i) for i in range(100)]
+    r1.search(cert).content = '\n'.join(old_lines)
+    r2.search(cert).content = '\n'.join(new_lines)
+    text = r1.get_diff(r2)[cert]['content']['diff']
+    assert text.splitlines()[-1] == new_lines[-1].join(['+', ''])
+    change = list(r1.iter_diff(r2))[0]
+    lines = list(change.unified_diff(max_size=1200))
+    assert sum(len(l) + 1 for l in lines[:-1]) <= 1200
+    assert lines[-1].startswith('... diff truncated')
+    assert list(change.unified_diff(max_size=1000)) == []
+
+def test_quick_check(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.fsio import io_counter, content_cache
+    root_path = str(conf_dir['root_path'])
+    domain = conf_dir['domains'][0]
+    fn = 'archive/{}/cert1.pem'.format(domain)
+    content_cache.clear()
+    r1 = build_tree(root_path, lazy=True)
+    r2 = build_tree(root_path, lazy=True)
+    with io_counter:
+        assert r1.is_equal(r2, quick_check=True)
+        assert r1.get_diff(r2, quick_check=True) == {}
+    assert io_counter['read'] == 0
+    assert r1.search(fn).quick_equal(r2.search(fn), ['size', 'modified', 'inode'])
+
+    # Same content with a new modified time falls back to a full comparison
+    r2.search(fn).modified += 1
+    with io_counter:
+        assert r1.is_equal(r2, quick_check=True)
+    assert io_counter['read'] == 2
+
+    r2.search(fn).content = 'foo\n'
+    assert not r1.is_equal(r2, quick_check=True)
+    assert list(r1.get_diff(r2, quick_check=True).keys()) == [fn]
+    # Changes with matching metadata are not found
+    r2.search(fn).modified -= 1
+    assert r1.is_equal(r2, quick_check=True)
+    assert not r1.is_equal(r2)
+
+def test_multi_diff(multi_conf_renewal_out_of_sync):
+    from letssync.structures import build_tree, diff
+    from letssync.structures.base import Path
+    base = multi_conf_renewal_out_of_sync['base']
+    renewed = multi_conf_renewal_out_of_sync['renewed']
+    r1 = build_tree(str(base['root_path']))
+    r2 = build_tree(str(renewed['root_path']))
+    r3 = Path.from_json(r1.to_json())
+    r4 = Path.from_json(r2.to_json())
+    domain = base['domains'][0]
+    r4.search('archive').remove_child(domain)
+    trees = [r1, r2, r3, r4]
+    names = ['base', 'renewed', 'base_copy', 'renewed_copy']
+    d = diff.get_multi_diff(trees, names)
+
+    pair = r1.get_diff(r2, 'renewed')
+    for key in pair:
+        if key.startswith('archive/{}/'.format(domain)):
+            continue
+        assert key in d
+        if key.startswith('live'):
+            assert d[key] == {
+                'groups':[['base', 'base_copy'], ['renewed', 'renewed_copy']],
+                'missing':[],
+            }
+    assert d['archive/{}'.format(domain)]['missing'] == ['renewed_copy']
+    for fn in ['cert', 'chain', 'fullchain', 'privkey']:
+        key = 'archive/{}/{}2.pem'.format(domain, fn)
+        assert d[key]['groups'] == [['renewed']]
+        assert d[key]['missing'] == ['base', 'base_copy', 'renewed_copy']
+        key = 'archive/{}/{}1.pem'.format(domain, fn)
+        assert key not in d
+    assert set(d.keys()) - set(pair.keys()) == {'archive/{}'.format(domain)}
+    assert diff.get_multi_diff([r1, r3]) == {}
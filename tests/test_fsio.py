@@ -0,0 +1,192 @@
+import os
+
+def iter_nodes(node):
+    yield node
+    for child in node.children.values():
+        for _node in iter_nodes(child):
+            yield _node
+
+def test_io_count(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Directory, FileObjBase, Link
+    from letssync.structures.fsio import io_counter
+    with io_counter:
+        r = build_tree(str(conf_dir['root_path']))
+    nodes = list(iter_nodes(r))
+    dirs = [n for n in nodes if isinstance(n, Directory)]
+    files = [n for n in nodes if isinstance(n, FileObjBase) and not isinstance(n, Link)]
+    links = [n for n in nodes if isinstance(n, Link)]
+    assert io_counter['stat'] == len(nodes)
+    assert io_counter['scandir'] == len(dirs)
+    assert io_counter['read'] == len(files)
+    assert io_counter['readlink'] == len(links)
+
+def test_stat_values(conf_dir):
+    from letssync.structures import build_tree
+    r = build_tree(str(conf_dir['root_path']))
+    for node in iter_nodes(r):
+        st = os.stat(node.path)
+        assert node.mode == st.st_mode
+        assert node.modified == st.st_mtime
+
+def test_lazy(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.fsio import io_counter, content_cache
+    from letssync.structures.account import AccountFile
+    r1 = build_tree(str(conf_dir['root_path']))
+    with io_counter:
+        r2 = build_tree(str(conf_dir['root_path']), lazy=True)
+        assert r2.is_equal(r1, metadata_only=True)
+        assert r1.is_equal(r2, metadata_only=True)
+    assert io_counter['read'] == 0
+
+    assert r1.is_equal(r2) and r2.is_equal(r1)
+    account = r2.search('accounts').accounts[conf_dir['account_id']]
+    assert set(account.domains) == set(conf_dir['domains'])
+    meta = account.search('meta.json')
+    assert isinstance(meta, AccountFile)
+    assert meta.data == r1.search(meta.relative_path).data
+
+    maxsize = content_cache.maxsize
+    content_cache.maxsize = 2
+    try:
+        with io_counter:
+            for node in iter_nodes(r2):
+                if isinstance(node, AccountFile):
+                    node.content
+            for node in iter_nodes(r2):
+                if isinstance(node, AccountFile):
+                    node.content
+        assert len(content_cache) <= 2
+        assert io_counter['read'] > 3
+    finally:
+        content_cache.maxsize = maxsize
+
+    # Parsed data is kept once handed out, so changes made in place remain
+    meta.data['letssync_test'] = 'foo'
+    content_cache.clear()
+    with io_counter:
+        assert meta.data['letssync_test'] == 'foo'
+    assert io_counter['read'] == 0
+    renewal = r2.search('renewal').children['{}.conf'.format(conf_dir['domains'][0])]
+    renewal.config['renewalparams']['letssync_test'] = 'foo'
+    content_cache.clear()
+    assert renewal.config['renewalparams']['letssync_test'] == 'foo'
+
+def test_parallel(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Directory, FileObjBase, Link
+    from letssync.structures.fsio import io_counter
+    r1 = build_tree(str(conf_dir['root_path']))
+    with io_counter:
+        r2 = build_tree(str(conf_dir['root_path']), workers=4)
+    nodes = list(iter_nodes(r2))
+    files = [n for n in nodes if isinstance(n, FileObjBase) and not isinstance(n, Link)]
+    assert io_counter['stat'] == len(nodes)
+    assert io_counter['read'] == len(files)
+    assert r2.fs.__name__ == 'letssync.structures.fsio'
+    assert r1.is_equal(r2) and r2.is_equal(r1)
+    assert [n.relative_path for n in iter_nodes(r1)] == [n.relative_path for n in nodes]
+    account = r2.search('accounts').accounts[conf_dir['account_id']]
+    assert set(account.domains) == set(conf_dir['domains'])
+
+    with io_counter:
+        r3 = build_tree(str(conf_dir['root_path']), workers=4, lazy=True)
+    assert io_counter['read'] == 0
+    assert r1.is_equal(r3) and r3.is_equal(r1)
+
+def test_batch_writer(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Directory, FileObjBase, Link
+    from letssync.structures import fsio
+    from letssync.structures.fsio import io_counter
+    t = tmpdir_factory.mktemp('batch')
+    r1 = build_tree(str(conf_dir['root_path']))
+    r2 = r1.copy(str(t))
+    nodes = list(iter_nodes(r2))
+    files = [n for n in nodes if isinstance(n, FileObjBase) and not isinstance(n, Link)]
+    dirs = set(os.path.dirname(n.path) for n in nodes if n.parent is not None)
+    with io_counter:
+        r2.write()
+    # One fsync per file and one per changed directory
+    assert io_counter['fsync'] == len(files) + len(dirs)
+    r3 = build_tree(str(t))
+    assert r3.is_equal(r1)
+    for node in iter_nodes(r3):
+        assert not node.id.endswith('.tmp')
+
+    p = str(t.join('file'))
+    umask = os.umask(0o077)
+    try:
+        fsio.write_file(p, 'a', 0o100644)
+    finally:
+        os.umask(umask)
+    assert os.stat(p).st_mode & 0o777 == 0o644
+
+    link = str(t.join('link'))
+    with fsio.BatchWriter() as writer:
+        writer.symlink('file', link)
+        writer.symlink('other', link)
+        assert writer.pending_dirs == set([str(t)])
+    assert os.readlink(link) == 'other'
+
+    # The temporary file is removed if the rename fails
+    d = t.join('dir')
+    d.ensure(dir=True)
+    before = set(os.listdir(str(t)))
+    try:
+        fsio.write_file(str(d), 'a')
+    except OSError:
+        pass
+    else:
+        assert False
+    assert set(os.listdir(str(t))) == before
+
+def test_write_executor(conf_dir, tmpdir_factory):
+    import time
+    import threading
+    import pytest
+    from letssync.structures import build_tree
+    from letssync.structures.fsio import WriteExecutor
+    order = []
+    lock = threading.Lock()
+    def task(key):
+        with lock:
+            order.append(key)
+        return key
+    executor = WriteExecutor(workers=4)
+    executor.add('a/b/c', task, ('a/b/c',), ['a/b'])
+    executor.add('a/b', task, ('a/b',), ['a'])
+    executor.add('link', task, ('link',), ['a/b/c', 'missing'])
+    executor.add('a', task, ('a',))
+    results = executor.run()
+    assert results == dict((key, key) for key in ['a', 'a/b', 'a/b/c', 'link'])
+    assert order == ['a', 'a/b', 'a/b/c', 'link']
+
+    executor = WriteExecutor()
+    executor.add('a', task, ('a',), ['b'])
+    executor.add('b', task, ('b',), ['a'])
+    with pytest.raises(ValueError):
+        executor.run()
+
+    # Tasks waiting to start are cancelled after a failure
+    order = []
+    def fail():
+        # Leaves time for the others to be queued behind it
+        time.sleep(.1)
+        raise OSError('failed')
+    executor = WriteExecutor(workers=1)
+    executor.add('fail', fail)
+    for key in ['a', 'b', 'c']:
+        executor.add(key, task, (key,))
+    with pytest.raises(OSError):
+        executor.run()
+    assert order == []
+
+    t = tmpdir_factory.mktemp('parallel_write')
+    r1 = build_tree(str(conf_dir['root_path']))
+    r2 = r1.copy(str(t))
+    r2.write(workers=4)
+    assert not r2.is_dirty
+    r3 = build_tree(str(t))
+    assert r3.is_equal(r1) and r1.is_equal(r3)
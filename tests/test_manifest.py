@@ -0,0 +1,22 @@
+
+def test_manifest(multi_conf_renewal_out_of_sync):
+    from letssync.structures import build_tree
+    from letssync.structures.manifest import Manifest
+    base = multi_conf_renewal_out_of_sync['base']
+    renewed = multi_conf_renewal_out_of_sync['renewed']
+    r1 = build_tree(str(base['root_path']))
+    r2 = build_tree(str(renewed['root_path']))
+    r3 = r1.copy()
+    m1 = r1.get_manifest()
+    m2 = Manifest.from_json(r2.get_manifest().to_json())
+    m3 = Manifest.from_json(r3.get_manifest().to_json())
+    assert len(m1.to_json()) < 512
+    assert m1 == m3
+    assert m1.get_changed(m3) == []
+    assert m1 != m2
+    changed = m1.get_changed(m2)
+    assert changed == ['archive', 'live', 'renewal']
+    for key in changed:
+        diff = r1.search(key).get_diff(r2.search(key))
+        assert len(diff)
+        assert all(p.startswith(key) for p in diff.keys())
@@ -0,0 +1,96 @@
+import os
+
+def build_sides(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    r = build_tree(str(conf_dir['root_path']))
+    js = r.to_json()
+    return js, Path.from_json(js), Path.from_json(js)
+
+def add_file(tree, rel_path, content):
+    from letssync.structures.base import FileObj
+    parent = tree.search(os.path.dirname(rel_path))
+    return parent.add_child(
+        FileObj, path=os.path.join(parent.path, os.path.basename(rel_path)),
+        content=content, mode=0o100644, modified=1.0,
+    )
+
+def test_merge(conf_dir):
+    from letssync.structures import merge
+    from letssync.structures.diff import ADDED, REMOVED, MODIFIED
+    d0, d1 = sorted(conf_dir['domains'])
+    js, a, b = build_sides(conf_dir)
+
+    # Changes on one side only
+    add_file(a, 'archive/{}/cert2.pem'.format(d0), 'renewed\n')
+    a.search('live/{}/cert.pem'.format(d0)).linked_path = '../../archive/{}/cert2.pem'.format(d0)
+    b.search('archive/{}'.format(d1)).remove_child('chain1.pem')
+    # The same change on both sides
+    for tree in [a, b]:
+        add_file(tree, 'archive/{}/same.pem'.format(d0), 'same\n')
+    # Conflicts
+    a.search('archive/{}/privkey1.pem'.format(d0)).content = 'a\n'
+    b.search('archive/{}/privkey1.pem'.format(d0)).content = 'b\n'
+    a.search('archive/{}'.format(d1)).remove_child('fullchain1.pem')
+    b.search('archive/{}/fullchain1.pem'.format(d1)).content = 'b\n'
+    add_file(a, 'archive/{}/new.pem'.format(d1), 'a\n')
+    add_file(b, 'archive/{}/new.pem'.format(d1), 'b\n')
+
+    plan = merge.merge(js, a, b)
+    changes = [(c.kind, c.side, c.relative_path) for c in plan.changes]
+    assert sorted(changes) == sorted([
+        (ADDED, 'a', 'archive/{}/cert2.pem'.format(d0)),
+        (MODIFIED, 'a', 'live/{}/cert.pem'.format(d0)),
+        (REMOVED, 'b', 'archive/{}/chain1.pem'.format(d1)),
+    ])
+    conflicts = [(c.reason, c.relative_path) for c in plan.conflicts]
+    assert sorted(conflicts) == sorted([
+        (merge.BOTH_MODIFIED, 'archive/{}/privkey1.pem'.format(d0)),
+        (merge.REMOVED_MODIFIED, 'archive/{}/fullchain1.pem'.format(d1)),
+        (merge.BOTH_ADDED, 'archive/{}/new.pem'.format(d1)),
+    ])
+    assert [c.relative_path for c in plan.get_changes('a')] == ['archive/{}/chain1.pem'.format(d1)]
+
+    plan.apply('a')
+    plan.apply('b')
+    link = b.search('live/{}/cert.pem'.format(d0))
+    assert link.linked_obj is b.search('archive/{}/cert2.pem'.format(d0))
+    assert b.search('archive/{}/cert2.pem'.format(d0)).content == 'renewed\n'
+    assert a.search('archive/{}/chain1.pem'.format(d1)) is None
+    assert not a.is_equal(b)
+
+    # Resolve the conflicts by taking side "a"
+    fn = 'archive/{}/privkey1.pem'.format(d0)
+    b.search(fn).content = a.search(fn).content
+    b.search('archive/{}'.format(d1)).remove_child('fullchain1.pem')
+    fn = 'archive/{}/new.pem'.format(d1)
+    b.search(fn).content = a.search(fn).content
+    assert a.is_equal(b)
+
+    plan = a.merge(js, b)
+    assert not len(plan.changes) and not len(plan.conflicts)
+
+def test_merge_modes(conf_dir):
+    from letssync.structures import merge
+    from letssync.structures.diff import MODIFIED
+    d0, d1 = sorted(conf_dir['domains'])
+    js, a, b = build_sides(conf_dir)
+    fn = 'archive/{}/privkey1.pem'.format(d0)
+    a.search(fn).mode = 0o100600
+    # Changed differently on both sides
+    conflict_fn = 'archive/{}/cert1.pem'.format(d1)
+    a.search(conflict_fn).mode = 0o100600
+    b.search(conflict_fn).mode = 0o100640
+
+    plan = merge.merge(js, a, b)
+    changes = [(c.kind, c.side, c.relative_path) for c in plan.changes]
+    assert changes == [(MODIFIED, 'a', fn)]
+    conflicts = [(c.reason, c.relative_path) for c in plan.conflicts]
+    assert conflicts == [(merge.BOTH_MODIFIED, conflict_fn)]
+    assert plan.get_delta('b')['modified'] == {fn: {'mode': 0o100600}}
+    plan.apply('b')
+    assert b.search(fn).mode == 0o100600
+
+    # Not found when modes are not checked
+    plan = merge.merge(js, a, b, check_modes=False)
+    assert not len(plan.changes) and not len(plan.conflicts)
@@ -0,0 +1,150 @@
+import os
+
+def test_snapshot_unchanged(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    from letssync.structures.snapshot import save
+    from letssync.structures.fsio import io_counter
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    fn = str(tmpdir_factory.mktemp('snapshot').join('snapshot.json'))
+    save(r1, fn)
+    with open(fn, 'rb') as f:
+        js_bytes = f.read()
+    for snapshot in [r1, r1.to_json(), js_bytes, fn]:
+        with io_counter:
+            r2 = build_tree(root_path, snapshot=snapshot)
+        assert io_counter['read'] == 0
+        assert io_counter['readlink'] == 0
+        assert r1.is_equal(r2) and r2.is_equal(r1)
+        assert r2.snapshot is None
+
+def test_snapshot_changed(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.fsio import io_counter
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    domain = conf_dir['domains'][0]
+    f = conf_dir['root_path'].join('archive', domain, 'chain1.pem')
+    f.write('foo\n')
+    st = os.stat(str(f))
+    os.utime(str(f), (st.st_atime, st.st_mtime + 10))
+    with io_counter:
+        r2 = build_tree(root_path, snapshot=r1.to_json())
+    assert io_counter['read'] == 1
+    node = r2.search(os.path.join('archive', domain, 'chain1.pem'))
+    assert node.content == 'foo\n'
+    assert r2.search(os.path.join('live', domain, 'chain.pem')).content == 'foo\n'
+    assert not r1.is_equal(r2)
+    r3 = build_tree(root_path)
+    assert r2.is_equal(r3) and r3.is_equal(r2)
+
+def test_snapshot_binary(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    from letssync.structures.snapshot import save
+    from letssync.structures.fsio import io_counter
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    fn = str(tmpdir_factory.mktemp('snapshot').join('snapshot.bin'))
+    save(r1, fn, use_binary=True)
+    for snapshot in [r1.to_binary(), fn]:
+        with io_counter:
+            r2 = build_tree(root_path, snapshot=snapshot)
+        assert io_counter['read'] == 0
+        assert r1.is_equal(r2) and r2.is_equal(r1)
+
+def test_delta(conf_dir):
+    import json
+    from conftest import generate_certs, build_cert_files
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    base_json = r1.to_json()
+    conf_dir['domain_indecies'] = {d: 2 for d in conf_dir['domains']}
+    conf_dir['certs'] = generate_certs(**conf_dir)
+    build_cert_files(**conf_dir)
+    r2 = build_tree(root_path)
+    d = r2.get_delta(base_json)
+    d = json.loads(json.dumps(d))
+    assert len(json.dumps(d)) < len(r2.to_json()) // 2
+    added = set(attrs['relative_path'] for attrs in d['added'])
+    expected = set()
+    for domain in conf_dir['domains']:
+        for fn in ['cert', 'chain', 'fullchain', 'privkey']:
+            expected.add('archive/{}/{}2.pem'.format(domain, fn))
+            rel_path = 'live/{}/{}.pem'.format(domain, fn)
+            assert d['modified'][rel_path]['linked_path'] == '../../archive/{}/{}2.pem'.format(domain, fn)
+    assert added == expected
+    assert d['removed'] == []
+
+    r3 = Path.from_json(base_json)
+    r3.apply_delta(d)
+    assert r2.is_equal(r3) and r3.is_equal(r2)
+    assert r3.search('live/example.com/cert.pem').content == r2.search('archive/example.com/cert2.pem').content
+
+def test_delta_removed(conf_dir):
+    import pytest
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    base_json = r1.to_json()
+    domain = conf_dir['domains'][0]
+    conf_dir['root_path'].join('renewal', '{}.conf'.format(domain)).remove()
+    r2 = build_tree(root_path)
+    d = r2.get_delta(r1)
+    assert d['removed'] == ['renewal/{}.conf'.format(domain)]
+    r3 = Path.from_json(base_json)
+    r3.apply_delta(d)
+    assert r2.is_equal(r3) and r3.is_equal(r2)
+    assert domain not in r3.search('renewal').domains
+    with pytest.raises(ValueError):
+        r3.apply_delta(d)
+
+def test_delta_added_account(conf_dir):
+    import json
+    from conftest import generate_account_id
+    from letssync.structures import build_tree
+    from letssync.structures.base import Path
+    root_path = str(conf_dir['root_path'])
+    base_json = build_tree(root_path).to_json()
+    account_id = generate_account_id()
+    account = conf_dir['root_path'].join(
+        'accounts', 'acme-v01.api.letsencrypt.org', 'directory', account_id,
+    )
+    account.ensure(dir=True)
+    for fn in ['meta.json', 'regr.json', 'private_key.json']:
+        account.join(fn).write(json.dumps({'fn':fn}))
+    r2 = build_tree(root_path)
+    d = r2.get_delta(base_json)
+    added = set(attrs['relative_path'] for attrs in d['added'])
+    assert 'accounts/acme-v01.api.letsencrypt.org/directory/{}'.format(account_id) in added
+
+    # Hashes already computed before the delta is applied
+    r3 = Path.from_json(base_json)
+    assert r3.tree_hash == d['base_hash']
+    r3.apply_delta(d)
+    assert r3.tree_hash == r2.tree_hash
+    assert account_id in r3.search('accounts').accounts
+
+def test_snapshot_not_shared(conf_dir):
+    from letssync.structures import build_tree
+    from letssync.structures.fsio import io_counter
+    root_path = str(conf_dir['root_path'])
+    r1 = build_tree(root_path)
+    with io_counter:
+        r2 = build_tree(root_path, snapshot=r1)
+    assert io_counter['read'] == 0
+    domain = conf_dir['domains'][0]
+    c1 = r1.search('renewal').domains[domain]
+    c2 = r2.search('renewal').domains[domain]
+    account = r1.search('accounts').accounts[conf_dir['account_id']]
+    a1 = account.children['meta.json']
+    a2 = r2.search(a1.relative_path)
+    assert c2.config is not c1.config
+    assert a2.data is not a1.data
+    c2.config['renewalparams']['account'] = 'changed'
+    a2.data['foo'] = 'bar'
+    assert c1.config['renewalparams']['account'] == conf_dir['account_id']
+    assert 'foo' not in a1.data
+    assert r1.is_equal(build_tree(root_path))
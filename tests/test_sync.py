@@ -0,0 +1,73 @@
+import os
+import stat
+
+def build_dest(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    t = tmpdir_factory.mktemp('sync')
+    src = build_tree(str(conf_dir['root_path']))
+    src.copy(str(t)).write()
+    return src, str(t)
+
+def test_sync_plan(conf_dir, tmpdir_factory):
+    from letssync.structures import build_tree
+    from letssync.structures.base import FileObj
+    from letssync.structures import sync
+    src, dest_path = build_dest(conf_dir, tmpdir_factory)
+    d0, d1 = sorted(conf_dir['domains'])
+    dest = build_tree(dest_path)
+
+    plan = src.get_sync_plan(dest)
+    assert len(plan) == 0
+    assert plan.bytes_written == 0
+
+    archive = src.search('archive/{}'.format(d0))
+    archive.children['privkey1.pem'].content = 'changed\n'
+    archive.children['chain1.pem'].mode = stat.S_IFREG | 0o600
+    archive.add_child(
+        FileObj, path=os.path.join(archive.path, 'cert2.pem'),
+        content='renewed\n', mode=stat.S_IFREG | 0o644, modified=1.0,
+    )
+    src.search('live/{}/cert.pem'.format(d0)).linked_path = '../../archive/{}/cert2.pem'.format(d0)
+    src.search('archive').remove_child(d1)
+    src.search('live').remove_child(d1)
+
+    plan = sync.plan_sync(src, dest)
+    ops = [(op.op, op.relative_path) for op in plan]
+    assert ops == [
+        (sync.DELETE, 'archive/{}'.format(d1)),
+        (sync.DELETE, 'live/{}'.format(d1)),
+        (sync.WRITE, 'archive/{}/privkey1.pem'.format(d0)),
+        (sync.WRITE, 'archive/{}/cert2.pem'.format(d0)),
+        (sync.CHMOD, 'archive/{}/chain1.pem'.format(d0)),
+        (sync.SYMLINK, 'live/{}/cert.pem'.format(d0)),
+    ]
+    assert plan.bytes_written == len('changed\n') + len('renewed\n')
+    assert plan.get_operations(sync.SYMLINK)[0].target == '../../archive/{}/cert2.pem'.format(d0)
+
+    # A dry run performs nothing
+    lines = plan.execute(dry_run=True)
+    assert len(lines) == len(ops)
+    assert os.path.exists(os.path.join(dest_path, 'archive', d1))
+
+    plan.execute(workers=4)
+    dest = build_tree(dest_path)
+    assert stat.S_IMODE(dest.search('archive/{}/chain1.pem'.format(d0)).mode) == 0o600
+    assert dest.search('live/{}/cert.pem'.format(d0)).content == 'renewed\n'
+    assert dest.search('archive/{}'.format(d1)) is None
+    assert len(sync.plan_sync(src, dest)) == 0
+
+    # A directory replaced by a file
+    os.mkdir(os.path.join(dest_path, 'archive', d0, 'extra'))
+    dest = build_tree(dest_path)
+    archive.add_child(
+        FileObj, path=os.path.join(archive.path, 'extra'),
+        content='extra\n', mode=stat.S_IFREG | 0o644, modified=1.0,
+    )
+    plan = sync.plan_sync(src, dest, check_modes=False)
+    ops = [(op.op, op.relative_path) for op in plan]
+    assert ops == [
+        (sync.DELETE, 'archive/{}/extra'.format(d0)),
+        (sync.WRITE, 'archive/{}/extra'.format(d0)),
+    ]
+    plan.execute()
+    assert len(sync.plan_sync(src, build_tree(dest_path))) == 0